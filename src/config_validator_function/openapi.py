@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import copy
+import functools
 import json
 
 from typing import Dict
@@ -21,15 +23,20 @@ action_name_map = {
     "rerank-items": "Rerank Items"
 }
 
+@functools.lru_cache(maxsize=8)
+def _load_openapi_template(shell_filename: str) -> Dict:
+    """ Loads and parses the OpenAPI template once per file for the lifetime of the execution environment """
+    logger.info('Loading openapi shell from %s', shell_filename)
+    with open(shell_filename) as file:
+        return json.loads(file.read())
+
 class OpenApiGenerator:
     def _get_openapi_template_filename(self) -> str:
         return OPENAPI_TEMPLATE_FILE
 
     def _get_openapi_template(self) -> Dict:
-        shell_filename = self._get_openapi_template_filename()
-        logger.info('Loading openapi shell from %s', shell_filename)
-        with open(shell_filename) as file:
-            return json.loads(file.read())
+        # generate() mutates the template so each call gets its own copy of the cached, parsed template.
+        return copy.deepcopy(_load_openapi_template(self._get_openapi_template_filename()))
 
     def generate(self, apis_config: Dict, apigw_host: str, cloudfront_host: str, auth_scheme: str) -> Dict:
         openapi = self._get_openapi_template()
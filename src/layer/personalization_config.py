@@ -17,21 +17,51 @@ tracer = Tracer()
 LOCAL_DB_FILENAME = 'p13n-item-metadata.db'
 LOCAL_DB_GZIP_FILENAME = LOCAL_DB_FILENAME + '.gz'
 
+# Config sections that a namespace inherits from the root and a recommender inherits from its namespace when not set.
+INHERITED_CONFIG_KEYS = ('autoContext', 'filters', 'cacheControl', 'inferenceItemMetadata')
+
 class PersonalizationConfig(ABC):
+    # Root config that the merged namespace/recommender configs below were resolved from. A reference is held
+    # (rather than just the version or id) so that a refreshed config, with or without a new version, is never
+    # served stale merges. Declared at class level so instances created without __init__ still work.
+    _merged_root: Dict = None
+    _merged: Dict[tuple, Dict] = None
+
     def __init__(self):
         pass
 
+    def _merged_configs(self, root_config: Dict) -> Dict[tuple, Dict]:
+        """ Returns the memoized merged configs for a root config, resetting them when the root config changes """
+        merged = self._merged
+        if merged is None or self._merged_root is not root_config:
+            merged = {}
+            self._merged_root = root_config
+            self._merged = merged
+        return merged
+
     def get_namespace_config(self, namespace_path: str) -> Dict:
-        config = None
         root_config = self.get_config()
+        merged = self._merged_configs(root_config)
+        key = ('namespace', namespace_path)
+        if key in merged:
+            return merged[key]
+
+        config = None
         if root_config:
             namespaces = root_config.get('namespaces')
             if namespaces:
                 config = self.inherit_config(root_config, namespaces.get(namespace_path))
 
+        merged[key] = config
         return config
 
     def get_recommender_config(self, namespace_path: str, recommender_path: str, api_action: str = None) -> Dict:
+        root_config = self.get_config()
+        merged = self._merged_configs(root_config)
+        key = ('recommender', namespace_path, recommender_path, api_action)
+        if key in merged:
+            return merged[key]
+
         config = None
         ns_config = self.get_namespace_config(namespace_path)
         if ns_config:
@@ -46,6 +76,7 @@ class PersonalizationConfig(ABC):
                         if action_config.get(recommender_path):
                             config = action_config.get(recommender_path)
 
+        merged[key] = config
         return config
 
     def get_version(self, default: str = None) -> str:
@@ -53,10 +84,11 @@ class PersonalizationConfig(ABC):
 
     def inherit_config(self, parent: Dict, config: Dict) -> Dict:
         if parent is not None and config is not None:
-            inherited = ['autoContext', 'filters', 'cacheControl', 'inferenceItemMetadata']
-            for inherit in inherited:
-                if config.get(inherit) is None and parent.get(inherit) is not None:
-                    config[inherit] = copy.copy(parent.get(inherit))
+            for inherit in INHERITED_CONFIG_KEYS:
+                if config.get(inherit) is None:
+                    value = parent.get(inherit)
+                    if value is not None:
+                        config[inherit] = copy.copy(value)
 
         return config
 
@@ -5,5 +5,12 @@ ACTION_RECOMMEND_ITEMS = 'recommend-items'
 ACTION_RELATED_ITEMS = 'related-items'
 ACTION_RERANK_ITEMS = 'rerank-items'
 
+# Name of the item list property in Personalize responses for each action
+ACTION_ITEMS_KEY_NAMES = {
+    ACTION_RECOMMEND_ITEMS: 'itemList',
+    ACTION_RELATED_ITEMS: 'itemList',
+    ACTION_RERANK_ITEMS: 'personalizedRanking'
+}
+
 LOCAL_DB_FILENAME = 'p13n_item_metadata.db'
 LOCAL_DB_GZIP_FILENAME = LOCAL_DB_FILENAME + '.gz'
\ No newline at end of file
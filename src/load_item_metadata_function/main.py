@@ -10,6 +10,11 @@ import json
 import dbm
 import gzip
 
+try:
+    import dbm.gnu as dbm_gnu
+except ImportError:
+    dbm_gnu = None
+
 from typing import Tuple
 from io import TextIOWrapper, RawIOBase
 from decimal import Decimal
@@ -68,7 +73,9 @@ def build_dbm_file(bucket: str, key: str, namespace: str):
     lines_read = 0
 
     logger.info('Building local DBM file')
-    with dbm.open(f'/tmp/{LOCAL_DB_FILENAME}', 'c') as db:
+    # Build GNU dbm files in fast mode (no sync after each write) since the file is only read once it is complete.
+    db_file = dbm_gnu.open(f'/tmp/{LOCAL_DB_FILENAME}', 'nf') if dbm_gnu else dbm.open(f'/tmp/{LOCAL_DB_FILENAME}', 'n')
+    with db_file as db:
         reader = jsonlines.Reader(TextIOWrapper(stream))
         for item in reader:
             lines_read += 1
@@ -1,15 +1,28 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import bisect
 import pytz
+import sys
 
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Tuple
 from aws_lambda_powertools import Logger, Tracer
 
 tracer = Tracer()
 logger = Logger(child=True)
 
+# Per month (January first): (day the season changes, season before that day, season from that day) for
+# the Northern hemisphere. Seasons change on March 21, June 21, September 23, and December 23.
+_NORTHERN_SEASONS = (
+    (1, 3, 3), (1, 3, 3), (21, 3, 0),
+    (1, 0, 0), (1, 0, 0), (21, 0, 1),
+    (1, 1, 1), (1, 1, 1), (23, 1, 2),
+    (1, 2, 2), (1, 2, 2), (23, 2, 3)
+)
+# Seasons are offset by two in the Southern hemisphere (Spring <-> Fall, Summer <-> Winter).
+_SOUTHERN_SEASONS = tuple((day, before ^ 2, after ^ 2) for day, before, after in _NORTHERN_SEASONS)
+
 def get_season(date: datetime, latitude: float = None) -> int:
     """ Determines season index (0-3) based on datetime and latitude
 
@@ -20,24 +33,24 @@ def get_season(date: datetime, latitude: float = None) -> int:
         3 = Winter
     Latitude is used to determine the Northern/Southern hemisphere
     """
-    md = date.month * 100 + date.day
-
-    if ((md > 320) and (md < 621)):
-        s = 0 # Spring
-    elif ((md > 620) and (md < 923)):
-        s = 1 # Summer
-    elif ((md > 922) and (md < 1223)):
-        s = 2 # Fall
-    else:
-        s = 3 # Winter
-
-    if latitude and latitude < 0:
-        if s < 2:
-            s += 2
-        else:
-            s -= 2
+    day, before, after = (_SOUTHERN_SEASONS if latitude and latitude < 0 else _NORTHERN_SEASONS)[date.month - 1]
+    return after if date.day >= day else before
+
+COMPILED_CACHE_MAX_SIZE = 256
+
+# Compiled rules memoized on the identity of the auto context config. Configs are replaced rather than mutated when the
+# configuration is refreshed. A reference to the config is held alongside its compiled rules so the id cannot be reused
+# by another object while the entry exists.
+_compiled_auto_contexts: Dict[int, Tuple[Dict, List]] = {}
+
+# A compiled rule resolves a value (or None) from the request headers and the current time.
+Rule = Callable[[Dict[str,str], datetime], Any]
+
+# Fields whose rules are all single "equals" header-value mappings (e.g. the CloudFront-Is-*-Viewer device type flags)
+# are resolved from a table of precomputed values indexed by which of the headers match. The table has 2^N entries.
+FLAG_RULES_MAX = 6
 
-    return s
+TIME_RULE_TYPES = ('hour-of-day', 'day-of-week', 'season-of-year')
 
 def resolve_auto_values(context_config: Dict, headers: Dict[str,str]) -> Dict[str,Dict[str,Any]]:
     """ Resolves automated context based on the specified config and headers
@@ -50,74 +63,195 @@ def resolve_auto_values(context_config: Dict, headers: Dict[str,str]) -> Dict[st
     if not context_config:
         return resolved_values
 
-    if headers.get('cloudfront-viewer-time-zone'):
-        tz = pytz.timezone(headers.get('cloudfront-viewer-time-zone'))
-        now = tz.localize(datetime.now())
-    else:
-        now = datetime.now()
+    # Header names are case-insensitive and rules use lowercase names so keys are normalized once per call rather than
+    # relying on the caller's dict (API Gateway passes header names as sent by the client/CloudFront).
+    headers = {key.lower(): value for key, value in headers.items()}
 
-    for field, auto_ctx in context_config.items():
-        values = set()
+    # The current time is determined once per call, and only when a time based rule needs it.
+    now = None
 
-        eval_all = auto_ctx.get('evaluateAll', False)
+    for field, field_type, eval_all, default, rules, flags, uses_time in compile_auto_context(context_config):
+        if uses_time and now is None:
+            now = _now(headers)
 
-        for rule in auto_ctx.get('rules'):
-            resolved = None
+        if flags:
+            flag_headers, table = flags
+            mask = 0
+            for header, value, bit in flag_headers:
+                if headers.get(header) == value:
+                    mask |= bit
+            values = table[mask]
+        else:
+            values = set()
 
-            if rule.get('type') == 'header-value':
-                header_value = headers.get(rule.get('header'))
-                resolved = _resolve(rule, header_value)
-            elif rule.get('type') == 'hour-of-day':
-                resolved = _resolve(rule, now.hour)
-            elif rule.get('type') == 'day-of-week':
-                resolved = _resolve(rule, now.weekday())
-            elif rule.get('type') == 'season-of-year':
-                season = get_season(now, headers.get('cloudfront-viewer-latitude'))
-                resolved = _resolve(rule, season)
+            for rule in rules:
+                resolved = rule(headers, now)
 
-            if resolved:
-                values.add(resolved)
-                if not eval_all:
-                    break
+                if resolved:
+                    values.add(resolved)
+                    if not eval_all:
+                        break
 
-        if len(values) == 0 and auto_ctx.get('default'):
-            values.add(auto_ctx['default'])
+            if len(values) == 0 and default:
+                values.add(default)
 
         if len(values) > 0:
             resolved_values[field] = {
                 'values': list(values)
             }
-            if auto_ctx.get('type'):
-                resolved_values[field]['type'] = auto_ctx['type']
+            if field_type:
+                resolved_values[field]['type'] = field_type
 
     return resolved_values
 
-def _resolve(rule: Dict, value: Any) -> Any:
-    resolved_value = None
-
-    if value is not None:
-        if rule.get('valueMappings'):
-            for value_mapping in rule.get('valueMappings'):
-                operator = value_mapping['operator']
-                mapping_value = value_mapping['value']
-                map_to = value_mapping['mapTo']
-
-                if operator == 'equals' and value == mapping_value:
-                    resolved_value = map_to
-                elif operator == 'less-than' and value < mapping_value:
-                    resolved_value = map_to
-                elif operator == 'greater-than' and value > mapping_value:
-                    resolved_value = map_to
-                elif operator == 'contains' and str(mapping_value) in str(value):
-                    resolved_value = map_to
-                elif operator == 'start-with' and str(value).startswith(str(mapping_value)):
-                    resolved_value = map_to
-                elif operator == 'ends-with' and str(value).endswith(str(mapping_value)):
-                    resolved_value = map_to
-
-                if resolved_value:
-                    break
-        else:
-            resolved_value = value
+def _now(headers: Dict[str,str]) -> datetime:
+    if headers.get('cloudfront-viewer-time-zone'):
+        tz = pytz.timezone(headers.get('cloudfront-viewer-time-zone'))
+        return tz.localize(datetime.now())
+    return datetime.now()
+
+def compile_auto_context(context_config: Dict) -> List[Tuple[str, str, bool, Any, List[Rule], Tuple, bool]]:
+    """ Returns the auto context config compiled to (field, type, evaluateAll, default, rules, flags, usesTime) tuples
+
+    Each rule is compiled once to a callable so resolving values for a request does not re-interpret the rule and
+    value mapping dicts. Flags is a (headers, table) tuple when the field can be resolved from a flag table, else None.
+    usesTime is True when resolving the field needs the current time.
+    """
+    entry = _compiled_auto_contexts.get(id(context_config))
+    if entry is not None and entry[0] is context_config:
+        return entry[1]
+
+    if len(_compiled_auto_contexts) >= COMPILED_CACHE_MAX_SIZE:
+        _compiled_auto_contexts.clear()
+
+    compiled = []
+    for field, auto_ctx in context_config.items():
+        rules = [rule for rule in map(_compile_rule, auto_ctx.get('rules')) if rule]
+        eval_all = auto_ctx.get('evaluateAll', False)
+        flags = _compile_flags(auto_ctx.get('rules'), eval_all, auto_ctx.get('default'))
+        uses_time = not flags and any(rule.get('type') in TIME_RULE_TYPES for rule in auto_ctx.get('rules'))
+        compiled.append((field, auto_ctx.get('type'), eval_all, auto_ctx.get('default'), rules, flags, uses_time))
+
+    _compiled_auto_contexts[id(context_config)] = (context_config, compiled)
+    return compiled
+
+def _compile_flags(rules: List[Dict], eval_all: bool, default: Any) -> Tuple:
+    """ Returns ((header, value, bit), ...) and the resolved values for every combination of matching headers
+
+    Returns None when any rule is not a header-value rule with a single "equals" mapping.
+    """
+    if not rules or len(rules) > FLAG_RULES_MAX:
+        return None
+
+    flag_headers = []
+    map_tos = []
+    for rule in rules:
+        value_mappings = [value_mapping for value_mapping in rule.get('valueMappings') or [] if value_mapping['mapTo']]
+        if rule.get('type') != 'header-value' or not rule.get('header') or len(value_mappings) != 1 or value_mappings[0]['operator'] != 'equals':
+            return None
+        flag_headers.append((sys.intern(rule['header'].lower()), value_mappings[0]['value'], 1 << len(flag_headers)))
+        map_tos.append(value_mappings[0]['mapTo'])
+
+    table = []
+    for mask in range(1 << len(map_tos)):
+        matched = [map_to for bit, map_to in enumerate(map_tos) if mask & (1 << bit)]
+        if not eval_all:
+            matched = matched[:1]
+        if not matched and default:
+            matched = [default]
+        table.append(tuple(dict.fromkeys(matched)))
+
+    return tuple(flag_headers), tuple(table)
+
+def _compile_rule(rule: Dict) -> Rule:
+    rule_type = rule.get('type')
+    resolve = _compile_value_mappings(rule.get('valueMappings'))
+
+    if rule_type == 'header-value':
+        header = rule.get('header')
+        header = sys.intern(header.lower()) if header else None
+        return lambda headers, now: resolve(headers.get(header))
+    elif rule_type == 'hour-of-day':
+        return lambda headers, now: resolve(now.hour)
+    elif rule_type == 'day-of-week':
+        return lambda headers, now: resolve(now.weekday())
+    elif rule_type == 'season-of-year':
+        def resolve_season(headers: Dict[str,str], now: datetime) -> Any:
+            latitude = headers.get('cloudfront-viewer-latitude')
+            return resolve(get_season(now, float(latitude) if latitude else None))
+        return resolve_season
+
+    return None
+
+def _compile_value_mappings(value_mappings: List[Dict]) -> Callable[[Any], Any]:
+    """ Returns a function that maps a value using the first matching value mapping (or the value itself if there are no mappings) """
+    if not value_mappings:
+        return lambda value: value
+
+    # Mappings that resolve to a falsy value can never produce a resolved value so they are dropped.
+    value_mappings = [value_mapping for value_mapping in value_mappings if value_mapping['mapTo']]
+
+    # A leading run of numeric less-than mappings (e.g. hour-of-day ranges) is resolved with a binary search over its
+    # thresholds. A threshold that is not greater than an earlier one can never be the first match so it is skipped,
+    # which leaves the thresholds sorted.
+    thresholds = []
+    outputs = []
+    leading = 0
+    for value_mapping in value_mappings:
+        mapping_value = value_mapping['value']
+        if value_mapping['operator'] != 'less-than' or not isinstance(mapping_value, (int, float)) or isinstance(mapping_value, bool):
+            break
+        leading += 1
+        if not thresholds or mapping_value > thresholds[-1]:
+            thresholds.append(mapping_value)
+            outputs.append(value_mapping['mapTo'])
+
+    remaining = value_mappings[leading:]
+
+    # When the remaining mappings are all equals (e.g. day-of-week or header flags), they are resolved with a single
+    # lookup. The first mapping for a value wins, as it would when the mappings are scanned in order.
+    equals = None
+    if all(value_mapping['operator'] == 'equals' for value_mapping in remaining):
+        try:
+            equals = {}
+            for value_mapping in remaining:
+                equals.setdefault(value_mapping['value'], value_mapping['mapTo'])
+            remaining = []
+        except TypeError: # Unhashable mapping value
+            equals = None
+
+    matchers = [(_compile_operator(value_mapping['operator'], value_mapping['value']), value_mapping['mapTo'])
+                    for value_mapping in remaining]
+
+    def resolve(value: Any) -> Any:
+        if value is not None:
+            if thresholds:
+                index = bisect.bisect_right(thresholds, value)
+                if index < len(thresholds):
+                    return outputs[index]
+            if equals:
+                return equals.get(value)
+            for matches, map_to in matchers:
+                if matches(value):
+                    return map_to
+        return None
+
+    return resolve
+
+def _compile_operator(operator: str, mapping_value: Any) -> Callable[[Any], bool]:
+    if operator == 'equals':
+        return lambda value: value == mapping_value
+    elif operator == 'less-than':
+        return lambda value: value < mapping_value
+    elif operator == 'greater-than':
+        return lambda value: value > mapping_value
+
+    mapping_str = str(mapping_value)
+    if operator == 'contains':
+        return lambda value: mapping_str in str(value)
+    elif operator == 'start-with':
+        return lambda value: str(value).startswith(mapping_str)
+    elif operator == 'ends-with':
+        return lambda value: str(value).endswith(mapping_str)
 
-    return resolved_value
+    return lambda value: False
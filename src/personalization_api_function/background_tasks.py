@@ -4,32 +4,50 @@
 import time
 
 from typing import List
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from aws_lambda_powertools import Logger, Tracer
 
 logger = Logger(child=True)
 tracer = Tracer()
 
+BACKGROUND_MAX_WORKERS = 4
+
+# Shared by all requests (and reused across warm invocations) so that a thread pool is not created and torn down per request.
+executor = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS, thread_name_prefix='bg')
+
 class BackgroundTasks():
-    def __init__(self):
-        self.pool: ThreadPoolExecutor = None
+    """ Submits tasks to the shared background executor for the scope of a request
+
+    Tasks submitted with submit() are waited for when the context exits. Tasks submitted with submit_detached() are
+    not (fire-and-forget) unless wait_detached is True, such as when preparing during initialization.
+    """
+    def __init__(self, pool: ThreadPoolExecutor = executor, wait_detached: bool = False):
+        self.pool = pool
+        self.wait_detached = wait_detached
         self.futures: List[Future] = []
-        self.pool_init = 0
+        self.start = 0
         self.task_count = 0
 
-    def submit(self, fn, /, *args, **kwargs):
-        if not self.pool:
-            self.pool_init = time.time()
-            self.pool = ThreadPoolExecutor()
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        if not self.futures:
+            self.start = time.time()
 
-        self.futures.append(self.pool.submit(fn, *args, **kwargs))
+        future = self.pool.submit(fn, *args, **kwargs)
+        self.futures.append(future)
         self.task_count += 1
+        return future
+
+    def submit_detached(self, fn, /, *args, **kwargs) -> Future:
+        if self.wait_detached:
+            return self.submit(fn, *args, **kwargs)
+
+        return self.pool.submit(fn, *args, **kwargs)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        if self.pool:
+        if self.futures:
             logger.info('Waiting for background tasks to complete')
-            self.pool.shutdown(True)
-            logger.info('%s background tasks completed in %0.2fms', self.task_count, time.time() - self.pool_init)
+            wait(self.futures)
+            logger.info('%s background tasks completed in %0.2fms', self.task_count, (time.time() - self.start) * 1000)
@@ -4,111 +4,161 @@
 """ AWS Lambda resolver that invokes a Lambda function to retrieve recommendations """
 
 import boto3
-import json
-import codecs
+import functools
+import orjson
+import hashlib
+import logging
 
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 from http import HTTPStatus
+from botocore.config import Config
 from aws_lambda_powertools import Logger, Tracer
 from personalization_error import LambdaError
 from personalization_constants import ACTION_RECOMMEND_ITEMS, ACTION_RELATED_ITEMS, ACTION_RERANK_ITEMS
+from util import ADAPTIVE_RETRIES, TTLCache, compat_default, config_hash, sampled_capture_method
 
 tracer = Tracer()
 logger = Logger(child=True)
 
 PAYLOAD_VERSION = '1.0'
 
+RESULT_CACHE_MAX_SIZE = 10000
+RESULT_CACHE_TTL = 5 # 5 seconds
+
+@functools.cache
+def get_lambda_client():
+    """ Returns the Lambda client, created on first use and then shared so TLS sessions are kept alive between bursts """
+    return boto3.client('lambda', config = Config(tcp_keepalive = True, max_pool_connections = 50, retries = ADAPTIVE_RETRIES, connect_timeout = 0.3))
+
 class LambdaResolver():
     def __init__(
         self,
-        lambda_client = boto3.client('lambda')
+        lambda_client = None
     ):
-        self.lambda_client = lambda_client
-
-    def _invoke_function(self, arn: str, context: Dict, payload: Dict) -> Dict:
+        self.lambda_client = lambda_client or get_lambda_client()
+        self._templates: Dict[Tuple, Dict] = {}
+        self._result_cache = TTLCache(RESULT_CACHE_MAX_SIZE, RESULT_CACHE_TTL)
+
+    @staticmethod
+    def _cache_key(variation_config: Dict, *args) -> Tuple:
+        """ Returns the result cache key for a request or None if result caching is disabled for the variation """
+        if variation_config.get('noCache'):
+            return None
+        return (config_hash(variation_config),) + args
+
+    def _payload_template(self, action: str, arn: str, recommender_path: str, recommender_config: Dict, variation_config: Dict) -> Dict:
+        """ Returns the invariant portion of the function payload for a recommender/variation
+
+        Templates are rebuilt only when the config objects they reference are replaced (i.e. after a config refresh).
+        """
+        key = (action, arn, recommender_path)
+        template = self._templates.get(key)
+        if not template or template['recommender']['config'] is not recommender_config or template['variation'] is not variation_config:
+            template = {
+                'version': PAYLOAD_VERSION,
+                'action': action,
+                'recommender': {
+                    'path': recommender_path,
+                    'config': recommender_config
+                },
+                'variation': variation_config
+            }
+            self._templates[key] = template
+
+        return template
+
+    def _invoke_function(self, arn: str, context: Dict, payload: Dict, cache_key: Tuple = None) -> Dict:
         if context:
-            if isinstance(context, str):
-                context = json.loads(context)
+            if isinstance(context, (str, bytes)):
+                context = orjson.loads(context)
             payload['context'] = context
 
+        if cache_key is not None:
+            if context:
+                cache_key += (hashlib.blake2b(orjson.dumps(context, option=orjson.OPT_SORT_KEYS), digest_size=8).digest(),)
+            # Cache the raw payload so that every hit is decoded into a fresh response that callers can mutate.
+            body = self._result_cache.get(cache_key)
+            if body is not None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Function %s result cache hit', arn)
+                return orjson.loads(body)
+
         response = self.lambda_client.invoke(
             FunctionName = arn,
             InvocationType = 'RequestResponse',
-            LogType = 'Tail', #'None'|'Tail',
-            Payload = codecs.encode(json.dumps(payload))
+            LogType = 'None', #'None'|'Tail' (tail logs are never read)
+            Payload = orjson.dumps(payload, default=compat_default)
         )
 
-        logger.debug(response)
+        status = response['StatusCode']
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Function %s invoke returned status %s', arn, status)
 
-        status = response.get('StatusCode', 0)
-        if status != HTTPStatus.OK:
+        if status != 200: # HTTPStatus.OK
             raise LambdaError(status, 'FunctionInvokeError', response.get('FunctionError'))
 
-        return json.load(response.get('Payload'))
+        # Errors raised by the function are returned with a 200 status and the error details as the payload.
+        function_error = response.get('FunctionError')
+        if function_error:
+            raise LambdaError(HTTPStatus.INTERNAL_SERVER_ERROR, 'FunctionError', f'Function returned error: {function_error}', status)
+
+        body = response.get('Payload').read()
+        if cache_key is not None:
+            self._result_cache.put(cache_key, body)
+
+        return orjson.loads(body)
 
-    @tracer.capture_method
+    @sampled_capture_method(tracer)
     def get_recommend_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, user_id: str, num_results: int = 25, context: Union[str,Dict] = None) -> Dict:
         arn = variation_config.get('arn')
         if not arn:
-            raise LambdaError(HTTPStatus.NOT_FOUND, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
+            raise LambdaError(404, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
 
-        logger.debug('Invoking function %s for recommend-items recommendation type', arn)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Invoking function %s for recommend-items recommendation type', arn)
 
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RECOMMEND_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
+            **self._payload_template(ACTION_RECOMMEND_ITEMS, arn, recommender_path, recommender_config, variation_config),
             'userId': user_id,
             'numResults': num_results
         }
 
-        return self._invoke_function(arn, context, payload)
+        cache_key = self._cache_key(variation_config, ACTION_RECOMMEND_ITEMS, recommender_path, user_id, num_results)
+        return self._invoke_function(arn, context, payload, cache_key)
 
-    @tracer.capture_method
+    @sampled_capture_method(tracer)
     def get_related_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, item_id: str, num_results: int = 25, user_id: str = None, context: Union[str,Dict] = None) -> Dict:
         arn = variation_config.get('arn')
         if not arn:
-            raise LambdaError(HTTPStatus.NOT_FOUND, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
+            raise LambdaError(404, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
 
-        logger.debug('Invoking function %s for related-items recommendation type', arn)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Invoking function %s for related-items recommendation type', arn)
 
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RELATED_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
+            **self._payload_template(ACTION_RELATED_ITEMS, arn, recommender_path, recommender_config, variation_config),
             'itemId': item_id,
             'userId': (user_id if user_id else ''),
             'numResults': num_results
         }
 
-        return self._invoke_function(arn, context, payload)
+        cache_key = self._cache_key(variation_config, ACTION_RELATED_ITEMS, recommender_path, item_id, user_id, num_results)
+        return self._invoke_function(arn, context, payload, cache_key)
 
-    @tracer.capture_method
+    @sampled_capture_method(tracer)
     def rerank_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, user_id: str, input_list: List[str], context: Union[str,Dict] = None) -> Dict:
         arn = variation_config.get('arn')
         if not arn:
-            raise LambdaError(HTTPStatus.NOT_FOUND, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
+            raise LambdaError(404, 'FunctionArnNotConfigured', 'Function ARN has not been configured for this namespace and recommender name')
 
-        logger.debug('Invoking function %s for rerank-items recommendation type', arn)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Invoking function %s for rerank-items recommendation type', arn)
 
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RERANK_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
+            **self._payload_template(ACTION_RERANK_ITEMS, arn, recommender_path, recommender_config, variation_config),
             'userId': user_id,
             'itemList': input_list
         }
 
-        return self._invoke_function(arn, context, payload)
+        cache_key = self._cache_key(variation_config, ACTION_RERANK_ITEMS, recommender_path, user_id, tuple(input_list))
+        return self._invoke_function(arn, context, payload, cache_key)
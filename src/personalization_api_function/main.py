@@ -9,41 +9,64 @@ recommendation requests as well as receiving events/interactions.
 
 import os
 import time
+import base64
+import functools
+import hashlib
 import json
+import orjson
 import traceback
-import urllib.request
 import botocore
-import urllib
+import urllib.parse
+import urllib3
 import zlib
 
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 from http import HTTPStatus
 from aws_lambda_powertools import Logger, Tracer, Metrics
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.event_handler.api_gateway import ApiGatewayResolver, ProxyEventType, CORSConfig, Response
 from personalization_config import PersonalizationConfig
-from personalization_constants import ACTION_RECOMMEND_ITEMS, ACTION_RELATED_ITEMS, ACTION_RERANK_ITEMS
+from personalization_constants import ACTION_RECOMMEND_ITEMS, ACTION_RELATED_ITEMS, ACTION_RERANK_ITEMS, ACTION_ITEMS_KEY_NAMES
 from response_decorator import ResponseDecorator
 from personalize_resolver import PersonalizeResolver
 from lambda_resolver import LambdaResolver
 from sagemaker_resolver import SageMakerResolver
 from response_post_process import PostProcessor
-from personalization_error import ConfigError, PersonalizationError, ValidationError, JSONDecodeValidationError
+from personalization_error import ConfigError, HttpError, PersonalizationError, ValidationError, JSONDecodeValidationError
 from evidently import evidently_evaluate_feature, process_conversions
 from event_targets import process_targets
 from auto_values import resolve_auto_values
 from background_tasks import BackgroundTasks
-from util import CompatEncoder
+from util import compat_default
 
 PERSONALIZE_GET_RECS_MAX_NUM_RESULTS = 500
+TRUTHY_VALUES = frozenset({'1', 'yes', 'true'})
+COMPRESS_MIN_SIZE = 1024 # Bodies smaller than this are not worth compressing
+COMPRESS_LEVEL = 1 # Fastest gzip level; JSON item lists compress well at any level
+# Include stack trace details in unhandled error responses (for troubleshooting only)
+DEBUG_ERRORS = os.environ.get('DEBUG_ERRORS', '0') == '1'
 
 tracer = Tracer()
 logger = Logger()
 metrics = Metrics()
 
+tracing_enabled = os.environ.get('POWERTOOLS_TRACE_DISABLED', 'false').lower() not in ['1', 'true']
+
+def capture_method(method):
+    """ Captures a method in a tracer subsegment only when tracing is enabled (avoids the wrapper overhead otherwise) """
+    return tracer.capture_method(method) if tracing_enabled else method
+
+def put_annotations(entry_point: str, namespace: str, recommender: str = None):
+    """ Annotates the current trace with the request entry point, namespace, and recommender when tracing is enabled """
+    if tracing_enabled:
+        tracer.put_annotation(key = 'EntryPoint', value = entry_point)
+        tracer.put_annotation(key = 'Namespace', value = namespace)
+        if recommender:
+            tracer.put_annotation(key = 'Recommender', value = recommender)
+
 cors_config = CORSConfig(max_age=500)
 api_type = os.environ.get('ApiType', 'REST')
-compress_responses = False  # Local compression
+compress_responses = False  # Local compression (see json_response())
 if api_type == 'HTTP':
     app = ApiGatewayResolver(proxy_type=ProxyEventType.APIGatewayProxyEventV2, cors=cors_config)
     compress_responses = True
@@ -56,15 +79,62 @@ else:
 
 config = PersonalizationConfig.get_instance()
 region = os.environ['AWS_REGION']
-personalize_resolver = PersonalizeResolver()
-lambda_resolver = LambdaResolver()
-sagemaker_resolver = SageMakerResolver()
-post_processor = PostProcessor()
-
-with BackgroundTasks() as background:
-    logger.info('Cold start prepare datastores')
+filter_arn_prefix = f'arn:aws:personalize:{region}:'
+account_id = None # Resolved from the first request's context
+
+# Connections to HTTP variation endpoints are pooled and reused across invocations. Failed requests are not retried
+# but redirects are followed.
+http_pool = urllib3.PoolManager(maxsize=16,
+                                retries=urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5),
+                                timeout=urllib3.Timeout(connect=0.5, read=2.0))
+
+# SnapStart and provisioned concurrency environments are initialized ahead of requests, so do as much
+# work as possible at import. On-demand environments defer work until it is needed by a request.
+initialization_type = os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE', 'on-demand')
+eager_init = initialization_type in ['snap-start', 'provisioned-concurrency']
+# In those environments resolvers (and their boto3 clients) are built at import so they are captured in the initialized
+# environment or snapshot rather than on the first request. Set EAGER_CLIENT_INIT to "1" to also build them at import
+# for on-demand environments.
+eager_client_init = eager_init or os.environ.get('EAGER_CLIENT_INIT', '0') == '1'
+
+@functools.cache
+def get_personalize_resolver() -> PersonalizeResolver:
+    return PersonalizeResolver()
+
+@functools.cache
+def get_lambda_resolver() -> LambdaResolver:
+    return LambdaResolver()
+
+@functools.cache
+def get_sagemaker_resolver() -> SageMakerResolver:
+    return SageMakerResolver()
+
+@functools.cache
+def get_post_processor() -> PostProcessor:
+    return PostProcessor()
+
+def prepare_datastores(background: BackgroundTasks):
+    """ Conditionally refreshes item metadata datastores (throttled by ResponseDecorator.PREPARE_CHECK_FREQUENCY) """
+    logger.debug('Conditionally refreshing datastores in the backgound')
     ResponseDecorator.prepare_datastores(config.get_config(), background)
 
+if eager_client_init:
+    get_personalize_resolver()
+    get_lambda_resolver()
+    get_sagemaker_resolver()
+    get_post_processor()
+
+if eager_init:
+    logger.info('Eagerly initializing for %s', initialization_type)
+    with BackgroundTasks(wait_detached = True) as background:
+        logger.info('Cold start prepare datastores')
+        prepare_datastores(background)
+
+@functools.lru_cache(maxsize=2048)
+def _request_checksum(path: str, query_string: str) -> str:
+    """ Returns a 64-bit hash (hex) of a request path and query string (memoized since callers tend to repeat URLs) """
+    return hashlib.blake2b(f'{path}?{query_string}'.encode(), digest_size=8).hexdigest()
+
 def generate_etag(max_age: int) -> str:
     """ Creates and returns a simple ETag header value that combines a checksum of the request with the current time and max_age.
 
@@ -81,7 +151,7 @@ def generate_etag(max_age: int) -> str:
             query_string = urllib.parse.urlencode(query_string_params)
         else:
             query_string = ''
-    checksum = zlib.adler32(f'{path}?{query_string}'.encode())
+    checksum = _request_checksum(path, query_string)
     millis = round(time.time() * 1000)
     return f'{checksum}-{millis}-{max_age}'
 
@@ -94,11 +164,12 @@ def is_resource_not_modified() -> bool:
     if not if_none_match:
         return False
 
-    etag_elements = if_none_match.split('-')
-    if len(etag_elements) < 2:
+    # ETag format is "{checksum}-{millis}-{max_age}" (see generate_etag())
+    etag_elements = if_none_match.rsplit('-', 2)
+    if len(etag_elements) < 3:
         return False
-    expires = int(etag_elements[-2]) + (int(etag_elements[-1]) * 1000)
-    return expires > (time.time() * 1000)
+    expires = int(etag_elements[1]) + (int(etag_elements[2]) * 1000)
+    return expires > time.time_ns() // 1_000_000
 
 def set_cache_headers(config: Dict, headers: Dict, user_id: str, user_is_synthetic: bool = False):
     """ Sets the caching related response headers based on the current configuration and request state.
@@ -108,14 +179,15 @@ def set_cache_headers(config: Dict, headers: Dict, user_id: str, user_is_synthet
     would cache responses more aggressively that did not include a user or for synthetic users and
     less aggressively for specific users.
     """
-    if not config.get('cacheControl'):
+    cache_control_config = config.get('cacheControl')
+    if not cache_control_config:
         return
 
     control_type = 'noUserSpecified'
     if user_id:
         control_type = 'syntheticUserSpecified' if user_is_synthetic else 'userSpecified'
 
-    cache_control = config['cacheControl'].get(control_type)
+    cache_control = cache_control_config.get(control_type)
 
     if cache_control:
         max_age = cache_control.get('maxAge')
@@ -129,7 +201,75 @@ def set_cache_headers(config: Dict, headers: Dict, user_id: str, user_is_synthet
         elif directives:
             headers['Cache-Control'] = directives
 
-@tracer.capture_method
+def encoded_response(body: bytes, headers: Dict) -> Response:
+    """ Builds an API response for a content encoded (e.g. gzipped) JSON body
+
+    The body is base64 encoded here since the resolver would otherwise try to serialize a non-str body as JSON.
+    """
+    response = Response(status_code=HTTPStatus.OK,
+                        content_type="application/json",
+                        body=base64.b64encode(body).decode(),
+                        headers=headers
+    )
+    response.base64_encoded = True
+    return response
+
+class UpstreamBody(NamedTuple):
+    """ JSON response body of an HTTP variation as received (body) and with its content encoding removed (decoded) """
+    body: bytes
+    content_encoding: Optional[str]
+    decoded: bytes
+
+def json_response(response: Union[Dict, UpstreamBody], headers: Dict) -> Response:
+    """ Serializes a response dictionary to JSON and builds the API response
+
+    An upstream body that is already serialized JSON is used as-is, keeping its content encoding when the API type
+    and caller allow it. For API types where compression is not handled by the API (HTTP and ALB), larger bodies are
+    gzipped here at the fastest compression level when the caller accepts it.
+    """
+    accept_encoding = (compress_responses and app.current_event.get_header_value(name='Accept-Encoding', default_value='')) or ''
+
+    if isinstance(response, UpstreamBody):
+        if response.content_encoding and response.content_encoding in accept_encoding:
+            headers['Content-Encoding'] = response.content_encoding
+            return encoded_response(response.body, headers)
+        body = response.decoded
+    else:
+        body = orjson.dumps(response, default=compat_default, option=orjson.OPT_NON_STR_KEYS)
+
+    if len(body) >= COMPRESS_MIN_SIZE and 'gzip' in accept_encoding:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        headers['Content-Encoding'] = 'gzip'
+        return encoded_response(compressor.compress(body) + compressor.flush(), headers)
+
+    return Response(status_code=HTTPStatus.OK,
+                    content_type="application/json",
+                    body=body.decode('utf-8'),
+                    headers=headers
+    )
+
+@capture_method
+def get_http_recommendations(variation_config: Dict, parse: bool = True) -> Union[Dict, UpstreamBody]:
+    """ Retrieves a response from the URL of an HTTP variation
+
+    When parse is False, the body is returned as received (along with its decoded form) so it can be passed through
+    to the caller.
+    """
+    url = variation_config['url'].format(**app.current_event.query_string_parameters)
+    response = http_pool.request('GET', url, headers={'Accept-Encoding': 'gzip'}, decode_content=parse)
+    if not 200 <= response.status < 300:
+        raise HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, 'HttpVariationError', f'HTTP variation request returned status {response.status}', response.status)
+    if parse:
+        return orjson.loads(response.data)
+
+    content_encoding = response.headers.get('Content-Encoding')
+    if content_encoding == 'gzip':
+        return UpstreamBody(response.data, content_encoding, zlib.decompress(response.data, zlib.MAX_WBITS | 16))
+    elif content_encoding and content_encoding != 'identity':
+        raise HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, 'HttpVariationError', f'HTTP variation response has unsupported content encoding {content_encoding}', response.status)
+    return UpstreamBody(response.data, None, response.data)
+
+@capture_method
 def evaluate_variations(rec_config: Dict, user_id: str, background: BackgroundTasks) -> Tuple:
     """ Evaluates the variations configured for a recommender to determine appropriate one to use for the request.
 
@@ -144,7 +284,7 @@ def evaluate_variations(rec_config: Dict, user_id: str, background: BackgroundTa
     if not experiments or len(variations) == 1 or not user_id:
         return config.inherit_config(rec_config, next(iter(variations.items()))[1]), None
 
-    feature = str(app.current_event.get_query_string_value(name="feature", default_value="")) or None
+    feature = get_query_string_param('feature')
     if feature:
         experiment = experiments.get(feature)
         if not experiment:
@@ -159,7 +299,25 @@ def evaluate_variations(rec_config: Dict, user_id: str, background: BackgroundTa
     else:
         raise ConfigError(HTTPStatus.INTERNAL_SERVER_ERROR, 'UnsupportedEvaluationMethod', 'Variation evaluation method is not configured/supported')
 
-def resolve_context(variation_config: Dict) -> Union[str, Dict]:
+def get_query_string_json(name: str, error_code: str) -> Optional[Dict]:
+    """ Returns the parsed JSON object of a query string parameter or None if it is missing or empty
+
+    Parameters are parsed once here so that resolvers can always expect a dictionary.
+    """
+    value = get_query_string_param(name)
+    if not value:
+        return None
+
+    try:
+        parsed = orjson.loads(value)
+    except orjson.JSONDecodeError:
+        parsed = None
+
+    if not isinstance(parsed, dict):
+        raise ValidationError(error_code, f'Parameter "{name}" is not valid JSON')
+    return parsed
+
+def resolve_context(variation_config: Dict) -> Optional[Dict]:
     """ Resolves automated context for the caller as configured for the recommender.
 
     Automated context can be used to derive contextual field values based on intrinsic data in the
@@ -167,23 +325,14 @@ def resolve_context(variation_config: Dict) -> Union[str, Dict]:
     CloudFront headers and time-based constructs such weekday, weekend, time of day, and seasonality
     can be derived from the time of the request and the user's time zone.
     """
-    context = str(app.current_event.get_query_string_value(name="context", default_value="")) or None
+    context = get_query_string_json('context', 'InvalidContextParameter')
 
     auto_context_config = variation_config.get('autoContext')
     if auto_context_config:
         auto_context = resolve_auto_values(auto_context_config, app.current_event.headers)
         if auto_context:
-            if not context:
-                context = {}
-            elif type(context) == str:
-                try:
-                    context = json.loads(context)
-                except json.decoder.JSONDecodeError:
-                    raise ValidationError('InvalidContextParameter', 'Parameter "context" is not valid JSON')
-
-            for field, resolved in auto_context.items():
-                if not field in context:
-                    context[field] = str(resolved['values'][0])
+            # Fields specified by the caller take precedence over automatically resolved fields.
+            context = {**{field: str(resolved['values'][0]) for field, resolved in auto_context.items()}, **(context or {})}
 
     return context
 
@@ -195,159 +344,192 @@ def resolve_filter_parameters(variation_config: Dict, user_id: str) -> Tuple:
     CloudFront headers and time-based constructs such weekday, weekend, time of day, and seasonality
     can be derived from the time of the request and the user's time zone.
     """
-    filter_name = str(app.current_event.get_query_string_value(name="filter", default_value="")) or None
-    filter_values = str(app.current_event.get_query_string_value(name="filterValues", default_value="")) or None
+    filter_name = get_query_string_param('filter')
 
     filter_arn = None
     if filter_name:
-        filter_arn = f'arn:aws:personalize:{region}:{app.current_event.request_context.account_id}:filter/{filter_name}'
+        global account_id
+        if not account_id:
+            account_id = app.current_event.request_context.account_id
+        filter_arn = f'{filter_arn_prefix}{account_id}:filter/{filter_name}'
     elif variation_config.get('filters'):
         for filter in variation_config['filters']:
             condition = filter.get('condition')
             if not condition or (user_id and condition == 'user-required'):
                 filter_arn = filter.get('arn')
                 break
-    else:
-        filter_values = None
 
-    if filter_arn and variation_config.get('filter') and variation_config['filter'].get('autoDynamicFilterValues'):
-        filter_auto_values = resolve_auto_values(variation_config['filter']['autoDynamicFilterValues'], app.current_event.headers)
+    filter_values = get_query_string_json('filterValues', 'InvalidFilterParameter') if filter_arn else None
+
+    filter_config = variation_config.get('filter')
+    auto_filter_config = filter_config.get('autoDynamicFilterValues') if filter_config else None
+    if filter_arn and auto_filter_config:
+        filter_auto_values = resolve_auto_values(auto_filter_config, app.current_event.headers)
         if filter_auto_values:
             if not filter_values:
                 filter_values = {}
-            elif type(filter_values) == str:
-                try:
-                    filter_values = json.loads(filter_values)
-                except json.decoder.JSONDecodeError:
-                    raise ValidationError('InvalidFilterParameter', 'Parameter "filterValues" is not valid JSON')
 
             for parameter, resolved in filter_auto_values.items():
                 if not parameter in filter_values:
                     if resolved.get('type') == 'string':
-                        filter_values[parameter] = ','.join(f'\\"{val}\\"' for val in resolved['values'])
+                        filter_values[parameter] = '\\"' + '\\",\\"'.join(map(str, resolved['values'])) + '\\"'
                     else:
                         filter_values[parameter] = str(resolved['values'][0])
 
     return filter_arn, filter_values
 
+def get_query_string_param(name: str) -> Optional[str]:
+    """ Returns the value of a query string parameter or None if it is missing or empty """
+    query_string_params = app.current_event.query_string_parameters
+    return (query_string_params.get(name) or None) if query_string_params else None
+
+def get_query_string_bool(name: str, default_value: str = '0') -> bool:
+    """ Returns whether a query string parameter is set to a truthy value ("1", "yes", or "true") """
+    return app.current_event.get_query_string_value(name=name, default_value=default_value).lower() in TRUTHY_VALUES
+
 def try_decorate_items() -> bool:
     """ Returns whether the caller wants to have returned items decorated with metadata (default is to decorate)"""
-    return app.current_event.get_query_string_value(name='decorateItems', default_value='1').lower() in ['1','yes','true']
+    return get_query_string_bool('decorateItems', '1')
 
-@tracer.capture_method
-def post_decorate_items(namespace: str, response: Dict):
+@capture_method
+def post_decorate_items(namespace: str, response: Dict, decorate: bool, items_key_name: str = None):
     """ Decorates items in the response with item metadata from the recommender or that is stored in a low-latency datastore
+
+    The items_key_name is only known up front for Personalize responses; it is detected for other variation types.
     """
-    if try_decorate_items():
+    if decorate:
         decorator = ResponseDecorator.get_instance(namespace, config)
         if decorator:
-            decorator.decorate(response)
+            decorator.decorate(response, items_key_name)
+
+# Resolver accessor and method for each supported (action, variation type). HTTP variations are handled separately.
+RESOLVER_METHODS = {
+    ACTION_RECOMMEND_ITEMS: 'get_recommend_items',
+    ACTION_RELATED_ITEMS: 'get_related_items',
+    ACTION_RERANK_ITEMS: 'rerank_items'
+}
+RESOLVER_DISPATCH = {
+    (action, variation_type): (get_resolver, method)
+    for action, method in RESOLVER_METHODS.items()
+    for variation_type, get_resolver in [
+        ('personalize-campaign', get_personalize_resolver),
+        ('personalize-recommender', get_personalize_resolver),
+        ('sagemaker', get_sagemaker_resolver),
+        ('function', get_lambda_resolver),
+        ('lambda', get_lambda_resolver) # Alias for "function" (used by earlier samples)
+    ]
+}
+PERSONALIZE_VARIATION_TYPES = frozenset({'personalize-campaign', 'personalize-recommender'})
+
+POST_PROCESSOR_METHODS = {
+    ACTION_RECOMMEND_ITEMS: 'process_recommend_items',
+    ACTION_RELATED_ITEMS: 'process_related_items',
+    ACTION_RERANK_ITEMS: 'process_rerank_items'
+}
+
+def resolve_items(action: str, namespace: str, recommender: str, rec_config: Dict, variation: Dict, request_args: Dict) -> Dict:
+    """ Retrieves the response for an action from the recommender for the variation and decorates the items
+
+    The request_args are the action specific resolver arguments (user_id, item_id, num_results, input_list, context).
+    """
+    variation_type = variation.get('type')
+    if variation_type == 'http':
+        return get_http_recommendations(variation)
 
-@app.get("/recommend-items/<namespace>/<recommender>/<user_id>", cors=True, compress=compress_responses)
-@tracer.capture_method(capture_response=False)
-def get_recommend_items(namespace: str, recommender: str, user_id: str) -> Response:
-    """ API entry point for getting recommended items for a given user """
-    tracer.put_annotation(key = 'EntryPoint', value = 'recommend-items')
-    tracer.put_annotation(key = 'Namespace', value = namespace)
-    tracer.put_annotation(key = 'Recommender', value = recommender)
+    dispatch = RESOLVER_DISPATCH.get((action, variation_type))
+    if not dispatch:
+        raise ConfigError(HTTPStatus.INTERNAL_SERVER_ERROR, 'UnsupportedVariationType', f'Variation type "{variation_type}" is not supported')
 
-    if is_resource_not_modified():
-        return Response(status_code=HTTPStatus.NOT_MODIFIED,
-                        content_type="text/plain",
-                        body='Not mofified'
+    get_resolver, method = dispatch
+    decorate = try_decorate_items()
+
+    if variation_type in PERSONALIZE_VARIATION_TYPES:
+        filter_arn, filter_values = resolve_filter_parameters(variation, request_args.get('user_id'))
+        if 'num_results' in request_args:
+            request_args['num_results'] = min(request_args['num_results'], PERSONALIZE_GET_RECS_MAX_NUM_RESULTS)
+
+        response = getattr(get_resolver(), method)(
+                variation_config = variation,
+                arn = variation.get('arn'),
+                filter_arn = filter_arn,
+                filter_values = filter_values,
+                include_metadata = decorate,
+                **request_args
         )
+        items_key_name = ACTION_ITEMS_KEY_NAMES[action]
+    else:
+        response = getattr(get_resolver(), method)(recommender, rec_config, variation, **request_args)
+        items_key_name = None
 
-    with BackgroundTasks() as background:
-        logger.debug('Conditionally refreshing datastores in the backgound')
-        ResponseDecorator.prepare_datastores(config.get_config(), background)
+    post_decorate_items(namespace, response, decorate, items_key_name)
+    return response
+
+def get_items(action: str, namespace: str, recommender: str, user_id: str, background: BackgroundTasks, item_id: str = None, input_list: List[str] = None) -> Tuple[Union[Dict, UpstreamBody], Dict]:
+    """ Resolves, post-processes, and trims the response for a recommend, related, or rerank items request
+
+    Returns the response and the variation used to resolve it. When an HTTP variation is used without an experiment
+    or post-processor, the upstream body is returned as-is (not re-serialized) unless it has to be trimmed.
+    """
+    rec_config = config.get_recommender_config(namespace, recommender, action)
+    if not rec_config:
+        raise ConfigError(HTTPStatus.NOT_FOUND, 'RecommenderNotConfigured', 'Recommender not configured for this namespace and recommender path')
 
-        rec_config = config.get_recommender_config(namespace, recommender, ACTION_RECOMMEND_ITEMS)
-        if not rec_config:
-            raise ConfigError(HTTPStatus.NOT_FOUND, 'RecommenderNotConfigured', 'Recommender not configured for this namespace and recommender path')
+    variation, experiment = evaluate_variations(rec_config, user_id, background)
 
-        variation, experiment = evaluate_variations(rec_config, user_id, background)
+    num_results = None
+    if action != ACTION_RERANK_ITEMS:
+        num_results = int(app.current_event.get_query_string_value(name="numResults", default_value="25"))
 
-        inference_num_results = num_results = int(app.current_event.get_query_string_value(name="numResults", default_value="25"))
-        context = resolve_context(variation)
+    post_process_config = rec_config.get('responsePostProcessor')
+    if not experiment and not post_process_config and variation.get('type') == 'http':
+        upstream = get_http_recommendations(variation, parse = False)
+        response = orjson.loads(upstream.decoded)
+        item_list = response.get('itemList')
+        if num_results is None or item_list is None or len(item_list) <= num_results:
+            return upstream, variation
+        del item_list[num_results:]
+        return response, variation
+
+    request_args = {
+        'user_id': user_id,
+        'context': resolve_context(variation)
+    }
+
+    if action == ACTION_RERANK_ITEMS:
+        request_args['input_list'] = input_list
+    else:
+        inference_num_results = num_results
 
-        post_process_config = rec_config.get('responsePostProcessor')
         if post_process_config and post_process_config.get('lookAheadMultiplier'):
             inference_num_results *= post_process_config['lookAheadMultiplier']
             if post_process_config.get('lookAheadMaximumValue'):
                 inference_num_results = min(inference_num_results, post_process_config['lookAheadMaximumValue'])
 
-        if variation.get('type') in ['personalize-campaign', 'personalize-recommender']:
-            arn = variation.get('arn')
-            filter_arn, filter_values = resolve_filter_parameters(variation, user_id)
-            inference_num_results = min(inference_num_results, PERSONALIZE_GET_RECS_MAX_NUM_RESULTS)
-
-            response = personalize_resolver.get_recommend_items(
-                    variation_config = variation,
-                    arn = arn,
-                    user_id = user_id,
-                    num_results = inference_num_results,
-                    filter_arn = filter_arn,
-                    filter_values = filter_values,
-                    context = context,
-                    include_metadata = try_decorate_items()
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'sagemaker':
-            response = sagemaker_resolver.get_recommend_items(
-                    recommender,
-                    rec_config,
-                    variation,
-                    user_id = user_id,
-                    num_results = inference_num_results,
-                    context = context
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'lambda':
-            response = lambda_resolver.get_recommend_items(
-                    recommender,
-                    rec_config,
-                    variation,
-                    user_id = user_id,
-                    num_results = inference_num_results,
-                    context = context
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'http':
-            url = variation['url'].format(**app.current_event.query_string_parameters)
-            response = json.loads(urllib.request.urlopen(url).read())
-
-        if response and experiment:
-            response['matchedExperiment'] = experiment
-
-        if post_process_config:
-            response = post_processor.process_recommend_items(recommender, rec_config, variation, user_id, response)
-
-        if len(response.get('itemList')) > num_results:
-            response['itemList'] = response['itemList'][:num_results]
+        request_args['num_results'] = inference_num_results
+        if action == ACTION_RELATED_ITEMS:
+            request_args['item_id'] = item_id
 
-        headers = {}
-        if config.get_version():
-            headers['X-Personalization-Config-Version'] = config.get_version()
+    response = resolve_items(action, namespace, recommender, rec_config, variation, request_args)
 
-        synthetic_user = app.current_event.get_query_string_value(name="syntheticUser", default_value="0").lower() in ['1','yes','true']
-        set_cache_headers(variation, headers, user_id, synthetic_user)
+    if response and experiment:
+        response['matchedExperiment'] = experiment
 
-        return Response(status_code=HTTPStatus.OK,
-                        content_type="application/json",
-                        body=json.dumps(response, cls=CompatEncoder),
-                        headers=headers
-        )
+    if post_process_config:
+        post_process = getattr(get_post_processor(), POST_PROCESSOR_METHODS[action])
+        response = post_process(recommender, rec_config, variation, item_id if action == ACTION_RELATED_ITEMS else user_id, response)
+
+    if num_results is not None:
+        item_list = response.get('itemList')
+        if item_list is not None and len(item_list) > num_results:
+            del item_list[num_results:]
+
+    return response, variation
 
-@app.get("/related-items/<namespace>/<recommender>/<item_id>", cors=True, compress=compress_responses)
+@app.get("/recommend-items/<namespace>/<recommender>/<user_id>", cors=True)
 @tracer.capture_method(capture_response=False)
-def get_related_items(namespace: str, recommender: str, item_id: str) -> Response:
-    """ API entry point for getting related items for a given item """
-    tracer.put_annotation(key = 'EntryPoint', value = 'related-items')
-    tracer.put_annotation(key = 'Namespace', value = namespace)
-    tracer.put_annotation(key = 'Recommender', value = recommender)
+def get_recommend_items(namespace: str, recommender: str, user_id: str) -> Response:
+    """ API entry point for getting recommended items for a given user """
+    put_annotations('recommend-items', namespace, recommender)
 
     if is_resource_not_modified():
         return Response(status_code=HTTPStatus.NOT_MODIFIED,
@@ -356,160 +538,54 @@ def get_related_items(namespace: str, recommender: str, item_id: str) -> Respons
         )
 
     with BackgroundTasks() as background:
-        logger.debug('Conditionally refreshing datastores in the backgound')
-        ResponseDecorator.prepare_datastores(config.get_config(), background)
-
-        rec_config = config.get_recommender_config(namespace, recommender, ACTION_RELATED_ITEMS)
-        if not rec_config:
-            raise ConfigError(HTTPStatus.NOT_FOUND, 'RecommenderNotConfigured', 'Recommender not configured for this namespace and recommender path')
-
-        user_id = str(app.current_event.get_query_string_value(name="userId", default_value="")) or None
+        prepare_datastores(background)
 
-        variation, experiment = evaluate_variations(rec_config, user_id, background)
-
-        inference_num_results = num_results = int(app.current_event.get_query_string_value(name="numResults", default_value="25"))
-        context = resolve_context(variation)
-
-        post_process_config = rec_config.get('responsePostProcessor')
-        if post_process_config and post_process_config.get('lookAheadMultiplier'):
-            inference_num_results *= post_process_config['lookAheadMultiplier']
-            if post_process_config.get('lookAheadMaximumValue'):
-                inference_num_results = min(inference_num_results, post_process_config['lookAheadMaximumValue'])
-
-        if variation.get('type') in ['personalize-campaign', 'personalize-recommender']:
-            arn = variation.get('arn')
-            filter_arn, filter_values = resolve_filter_parameters(variation, user_id)
-            inference_num_results = min(inference_num_results, PERSONALIZE_GET_RECS_MAX_NUM_RESULTS)
-
-            response =  personalize_resolver.get_related_items(
-                    variation_config = variation,
-                    arn = arn,
-                    item_id = item_id,
-                    num_results = inference_num_results,
-                    filter_arn = filter_arn,
-                    filter_values = filter_values,
-                    user_id = user_id,
-                    context = context,
-                    include_metadata = try_decorate_items()
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'sagemaker':
-            response = sagemaker_resolver.get_related_items(
-                    recommender,
-                    rec_config,
-                    variation,
-                    item_id = item_id,
-                    num_results = inference_num_results,
-                    user_id = user_id,
-                    context = context
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'lambda':
-            response = lambda_resolver.get_related_items(
-                    recommender,
-                    rec_config,
-                    variation,
-                    item_id = item_id,
-                    num_results = inference_num_results,
-                    user_id = user_id,
-                    context = context
-            )
-
-            post_decorate_items(namespace, response)
-        elif variation.get('type') == 'http':
-            url = variation['url'].format(**app.current_event.query_string_parameters)
-            response = json.loads(urllib.request.urlopen(url).read())
-
-        if response and experiment:
-            response['matchedExperiment'] = experiment
-
-        if post_process_config:
-            response = post_processor.process_related_items(recommender, rec_config, variation, item_id, response)
-
-        if len(response.get('itemList')) > num_results:
-            response['itemList'] = response['itemList'][:num_results]
+        response, variation = get_items(ACTION_RECOMMEND_ITEMS, namespace, recommender, user_id, background)
 
         headers = {}
-        if config.get_version():
-            headers['X-Personalization-Config-Version'] = config.get_version()
+        version = config.get_version()
+        if version:
+            headers['X-Personalization-Config-Version'] = version
 
-        synthetic_user = app.current_event.get_query_string_value(name="syntheticUser", default_value="0").lower() in ['1','yes','true']
+        synthetic_user = get_query_string_bool('syntheticUser')
         set_cache_headers(variation, headers, user_id, synthetic_user)
 
-        return Response(status_code=HTTPStatus.OK,
-                        content_type="application/json",
-                        body=json.dumps(response, cls=CompatEncoder),
-                        headers=headers
-        )
-
-def _rerank_items(namespace: str, recommender: str, user_id: str, item_ids: List[str], background: BackgroundTasks) -> Tuple[Response, Dict]:
-    rec_config = config.get_recommender_config(namespace, recommender, ACTION_RERANK_ITEMS)
-    if not rec_config:
-        raise ConfigError(HTTPStatus.NOT_FOUND, 'RecommenderNotConfigured', 'Recommender not configured for this namespace and recommender path')
-
-    variation, experiment = evaluate_variations(rec_config, user_id, background)
-    context = resolve_context(variation)
+        return json_response(response, headers)
 
-    if variation.get('type') in ['personalize-campaign', 'personalize-recommender']:
-        arn = variation.get('arn')
-        filter_arn, filter_values = resolve_filter_parameters(variation, user_id)
+@app.get("/related-items/<namespace>/<recommender>/<item_id>", cors=True)
+@tracer.capture_method(capture_response=False)
+def get_related_items(namespace: str, recommender: str, item_id: str) -> Response:
+    """ API entry point for getting related items for a given item """
+    put_annotations('related-items', namespace, recommender)
 
-        response = personalize_resolver.rerank_items(
-                variation_config = variation,
-                arn = arn,
-                user_id = user_id,
-                input_list = item_ids,
-                filter_arn = filter_arn,
-                filter_values = filter_values,
-                context = context,
-                include_metadata = try_decorate_items()
+    if is_resource_not_modified():
+        return Response(status_code=HTTPStatus.NOT_MODIFIED,
+                        content_type="text/plain",
+                        body='Not mofified'
         )
 
-        post_decorate_items(namespace, response)
-    elif variation.get('type') == 'sagemaker':
-        response = sagemaker_resolver.rerank_items(
-                recommender,
-                rec_config,
-                variation,
-                user_id = user_id,
-                input_list = item_ids,
-                context = context
-        )
+    with BackgroundTasks() as background:
+        prepare_datastores(background)
 
-        post_decorate_items(namespace, response)
-    elif variation.get('type') == 'lambda':
-        response = lambda_resolver.rerank_items(
-                recommender,
-                rec_config,
-                variation,
-                user_id = user_id,
-                input_list = item_ids,
-                context = context
-        )
+        user_id = get_query_string_param('userId')
 
-        post_decorate_items(namespace, response)
-    elif variation.get('type') == 'http':
-        url = variation['url'].format(**app.current_event.query_string_parameters)
-        response = json.loads(urllib.request.urlopen(url).read())
+        response, variation = get_items(ACTION_RELATED_ITEMS, namespace, recommender, user_id, background, item_id = item_id)
 
-    if response and experiment:
-        response['matchedExperiment'] = experiment
+        headers = {}
+        version = config.get_version()
+        if version:
+            headers['X-Personalization-Config-Version'] = version
 
-    post_process_config = rec_config.get('responsePostProcessor')
-    if post_process_config:
-        response = post_processor.process_rerank_items(recommender, rec_config, variation, user_id, response)
+        synthetic_user = get_query_string_bool('syntheticUser')
+        set_cache_headers(variation, headers, user_id, synthetic_user)
 
-    return response, variation
+        return json_response(response, headers)
 
-@app.get("/rerank-items/<namespace>/<recommender>/<user_id>/<item_ids>", cors=True, compress=compress_responses)
+@app.get("/rerank-items/<namespace>/<recommender>/<user_id>/<item_ids>", cors=True)
 @tracer.capture_method(capture_response=False)
 def get_rerank_items(namespace: str, recommender: str, user_id: str, item_ids: str) -> Response:
     """ API entry point for reranking a list of items for a given user """
-    tracer.put_annotation(key = 'EntryPoint', value = 'rerank-items')
-    tracer.put_annotation(key = 'Namespace', value = namespace)
-    tracer.put_annotation(key = 'Recommender', value = recommender)
+    put_annotations('rerank-items', namespace, recommender)
 
     if is_resource_not_modified():
         return Response(status_code=HTTPStatus.NOT_MODIFIED,
@@ -518,36 +594,29 @@ def get_rerank_items(namespace: str, recommender: str, user_id: str, item_ids: s
         )
 
     with BackgroundTasks() as background:
-        logger.debug('Conditionally refreshing datastores in the backgound')
-        ResponseDecorator.prepare_datastores(config.get_config(), background)
+        prepare_datastores(background)
 
         input_list = item_ids.split(',')
-        response, variation = _rerank_items(namespace, recommender, user_id, input_list, background)
+        response, variation = get_items(ACTION_RERANK_ITEMS, namespace, recommender, user_id, background, input_list = input_list)
 
         headers = {}
-        if config.get_version():
-            headers['X-Personalization-Config-Version'] = config.get_version()
+        version = config.get_version()
+        if version:
+            headers['X-Personalization-Config-Version'] = version
 
-        synthetic_user = app.current_event.get_query_string_value(name="syntheticUser", default_value="0").lower() in ['1','yes','true']
+        synthetic_user = get_query_string_bool('syntheticUser')
         set_cache_headers(variation, headers, user_id, synthetic_user)
 
-        return Response(status_code=HTTPStatus.OK,
-                        content_type="application/json",
-                        body=json.dumps(response, cls=CompatEncoder),
-                        headers=headers
-        )
+        return json_response(response, headers)
 
-@app.post("/rerank-items/<namespace>/<recommender>/<user_id>", cors=True, compress=compress_responses)
+@app.post("/rerank-items/<namespace>/<recommender>/<user_id>", cors=True)
 @tracer.capture_method(capture_response=False)
 def post_rerank_items(namespace: str, recommender: str, user_id: str) -> Response:
     """ API entry point for reranking a list of items for a given user """
-    tracer.put_annotation(key = 'EntryPoint', value = 'rerank-items')
-    tracer.put_annotation(key = 'Namespace', value = namespace)
-    tracer.put_annotation(key = 'Recommender', value = recommender)
+    put_annotations('rerank-items', namespace, recommender)
 
     with BackgroundTasks() as background:
-        logger.debug('Conditionally refreshing datastores in the backgound')
-        ResponseDecorator.prepare_datastores(config.get_config(), background)
+        prepare_datastores(background)
 
         try:
             input_list = app.current_event.json_body
@@ -557,25 +626,21 @@ def post_rerank_items(namespace: str, recommender: str, user_id: str) -> Respons
         if not isinstance(input_list, list):
             raise ValidationError('InvalidRequestPayload', 'Request body must be valid JSON (array of item IDs)')
 
-        response,_ = _rerank_items(namespace, recommender, user_id, input_list)
+        response,_ = get_items(ACTION_RERANK_ITEMS, namespace, recommender, user_id, background, input_list = input_list)
 
         # No cache for you.
         headers = { 'Cache-Control': 'no-store' }
-        if config.get_version():
-            headers['X-Personalization-Config-Version'] = config.get_version()
+        version = config.get_version()
+        if version:
+            headers['X-Personalization-Config-Version'] = version
 
-        return Response(status_code=HTTPStatus.OK,
-                        content_type="application/json",
-                        body=json.dumps(response, cls=CompatEncoder),
-                        headers=headers
-        )
+        return json_response(response, headers)
 
 @app.post("/events/<namespace>", cors=True)
 @tracer.capture_method(capture_response=False)
 def post_put_events(namespace: str) -> Response:
     """ API entry point for incrementally sending events/interactions back to recommenders """
-    tracer.put_annotation(key = 'EntryPoint', value = 'events')
-    tracer.put_annotation(key = 'Namespace', value = namespace)
+    put_annotations('events', namespace)
 
     ns_config = config.get_namespace_config(namespace)
     if not ns_config:
@@ -586,8 +651,9 @@ def post_put_events(namespace: str) -> Response:
 
     # No cache for you.
     headers = { 'Cache-Control': 'no-store' }
-    if config.get_version():
-        headers['X-Personalization-Config-Version'] = config.get_version()
+    version = config.get_version()
+    if version:
+        headers['X-Personalization-Config-Version'] = version
 
     return Response(status_code = HTTPStatus.OK,
                     content_type = 'text/plain',
@@ -608,11 +674,11 @@ def lambda_handler(event, context):
             'headers': {
                 "Content-Type" : "application/json"
             },
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'type': e.type,
                 'code': e.error_code,
                 'message': e.error_message
-            })
+            }).decode('utf-8')
         }
     except botocore.exceptions.ParamValidationError as e:
         logger.exception(e)
@@ -621,24 +687,25 @@ def lambda_handler(event, context):
             'headers': {
                 "Content-Type" : "application/json"
             },
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'type': 'Validation',
                 'code': 'ValidationError',
                 'message': str(e)
-            })
+            }).decode('utf-8')
         }
     except Exception as e:
         logger.exception(e)
-        formatted_lines = traceback.format_exc().splitlines()
+        body = {
+            'type': 'Unhandled',
+            'code': 'InternalError',
+            'message': str(e)
+        }
+        if DEBUG_ERRORS:
+            body['details'] = traceback.format_exc().splitlines()
         return {
             'statusCode': HTTPStatus.INTERNAL_SERVER_ERROR,
             'headers': {
                 "Content-Type" : "application/json"
             },
-            'body': json.dumps({
-                'type': 'Unhandled',
-                'code': 'InternalError',
-                'message': str(e),
-                'details': formatted_lines
-            }, indent = 2)
+            'body': orjson.dumps(body).decode('utf-8')
         }
@@ -116,3 +116,13 @@ class SageMakerError(PersonalizationError):
         sdk_status_code: int = None
     ):
         super().__init__('SageMaker', status_code, error_code, error_message, sdk_status_code)
+
+class HttpError(PersonalizationError):
+    def __init__(
+        self,
+        status_code: int,
+        error_code: str,
+        error_message: str,
+        sdk_status_code: int = None
+    ):
+        super().__init__('HTTP', status_code, error_code, error_message, sdk_status_code)
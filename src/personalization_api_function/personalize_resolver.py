@@ -3,26 +3,80 @@
 
 """ Amazon Personalize resolver that calls Personalize campaigns or recommenders """
 
-import json
 import boto3
+import functools
 
-from typing import Dict, List, Union
+from typing import Dict, List
 from http import HTTPStatus
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger, Tracer, Metrics
 from aws_lambda_powertools.metrics import MetricUnit
 from personalization_error import PersonalizeError
+from util import ADAPTIVE_RETRIES
 
 tracer = Tracer()
 logger = Logger(child=True)
 metrics = Metrics()
 
+@functools.cache
+def get_personalize_runtime():
+    """ Returns the Personalize runtime client, created on first use and then shared so TLS sessions are kept alive between bursts """
+    return boto3.client('personalize-runtime', config = Config(
+        tcp_keepalive = True,
+        max_pool_connections = 50,
+        retries = ADAPTIVE_RETRIES,
+        connect_timeout = 0.3,
+        read_timeout = 2.5
+    ))
+
+@functools.lru_cache(maxsize=256)
+def arn_param_name(arn: str) -> str:
+    """ Returns the name of the request parameter for a recommender or campaign ARN """
+    return 'recommenderArn' if arn.split(':', 6)[5].startswith('recommender/') else 'campaignArn'
+
+def drop_response_metadata(parsed: Dict, **kwargs):
+    """ Removes the metadata from successful responses as they are parsed since it is not returned to callers
+
+    Error responses keep it since PersonalizeError.from_client_error() reads the HTTP status code from it.
+    """
+    if 'Error' not in parsed:
+        parsed.pop('ResponseMetadata', None)
+
 class PersonalizeResolver():
     def __init__(
         self,
-        personalize = boto3.client('personalize-runtime')
+        personalize = None
     ):
-        self.personalize_runtime = personalize
+        self.personalize_runtime = personalize or get_personalize_runtime()
+        self.personalize_runtime.meta.events.register('after-call.personalize-runtime', drop_response_metadata, unique_id = 'drop-response-metadata')
+
+    @staticmethod
+    def _augment_params(
+            params: Dict,
+            variation_config: Dict,
+            arn: str,
+            filter_arn: str,
+            filter_values: Dict,
+            context: Dict,
+            include_metadata: bool
+        ):
+        """ Adds the ARN, filter, context, and metadata column parameters shared by all Personalize inference calls """
+        params[arn_param_name(arn)] = arn
+
+        if filter_arn:
+            params['filterArn'] = filter_arn
+            if filter_values:
+                params['filterValues'] = filter_values
+
+        if context:
+            params['context'] = context
+
+        metadata_config = variation_config.get('inferenceItemMetadata')
+        if include_metadata and metadata_config and metadata_config.get('type') == 'personalize':
+            params['metadataColumns'] = {
+                'ITEMS': metadata_config.get('itemColumns')
+            }
 
     @tracer.capture_method
     def get_recommend_items(
@@ -32,8 +86,8 @@ class PersonalizeResolver():
             user_id: str,
             num_results: int = 25,
             filter_arn: str = None,
-            filter_values: Union[str,Dict] = None,
-            context: Union[str,Dict] = None,
+            filter_values: Dict = None,
+            context: Dict = None,
             include_metadata: bool = True
         ) -> Dict:
 
@@ -45,37 +99,13 @@ class PersonalizeResolver():
             'numResults': num_results
         }
 
-        is_recommender = arn.split(':')[5].startswith('recommender/')
-        if is_recommender:
-            params['recommenderArn'] = arn
-        else:
-            params['campaignArn'] = arn
-
-        if filter_arn:
-            params['filterArn'] = filter_arn
-            if filter_values:
-                if isinstance(filter_values, str):
-                    filter_values = json.loads(filter_values)
-                params['filterValues'] = filter_values
-
-        if context:
-            if isinstance(context, str):
-                context = json.loads(context)
-            params['context'] = context
-
-        metadata_config = variation_config.get('inferenceItemMetadata')
-        if include_metadata and metadata_config and metadata_config.get('type') == 'personalize':
-            item_columns = metadata_config.get('itemColumns')
-            params['metadataColumns'] = {
-                'ITEMS': item_columns
-            }
+        self._augment_params(params, variation_config, arn, filter_arn, filter_values, context, include_metadata)
 
         logger.debug('Calling personalize.get_recommendations() with arguments: %s', params)
 
         try:
             response = self.personalize_runtime.get_recommendations(**params)
             logger.debug(response)
-            del response['ResponseMetadata']
         except ClientError as e:
             if e.response['Error']['Code'] == 'ThrottlingException':
                 metrics.add_dimension(name="Arn", value=arn)
@@ -92,9 +122,9 @@ class PersonalizeResolver():
             item_id: str,
             num_results: int = 25,
             filter_arn: str = None,
-            filter_values: Union[str,Dict] = None,
+            filter_values: Dict = None,
             user_id: str = None,
-            context: Union[str,Dict] = None,
+            context: Dict = None,
             include_metadata: bool = True
         ) -> Dict:
 
@@ -106,40 +136,16 @@ class PersonalizeResolver():
             'numResults': num_results
         }
 
-        is_recommender = arn.split(':')[5].startswith('recommender/')
-        if is_recommender:
-            params['recommenderArn'] = arn
-        else:
-            params['campaignArn'] = arn
-
         if user_id:
             params['userId'] = user_id
 
-        if filter_arn:
-            params['filterArn'] = filter_arn
-            if filter_values:
-                if isinstance(filter_values, str):
-                    filter_values = json.loads(filter_values)
-                params['filterValues'] = filter_values
-
-        if context:
-            if isinstance(context, str):
-                context = json.loads(context)
-            params['context'] = context
-
-        metadata_config = variation_config.get('inferenceItemMetadata')
-        if include_metadata and metadata_config and metadata_config.get('type') == 'personalize':
-            item_columns = metadata_config.get('itemColumns')
-            params['metadataColumns'] = {
-                'ITEMS': item_columns
-            }
+        self._augment_params(params, variation_config, arn, filter_arn, filter_values, context, include_metadata)
 
         logger.debug('Calling personalize.get_recommendations() with arguments: %s', params)
 
         try:
             response = self.personalize_runtime.get_recommendations(**params)
             logger.debug(response)
-            del response['ResponseMetadata']
         except ClientError as e:
             if e.response['Error']['Code'] == 'ThrottlingException':
                 metrics.add_dimension(name="Arn", value=arn)
@@ -157,8 +163,8 @@ class PersonalizeResolver():
             user_id: str,
             input_list: List[str],
             filter_arn: str = None,
-            filter_values: Union[str,Dict] = None,
-            context: Union[str,Dict] = None,
+            filter_values: Dict = None,
+            context: Dict = None,
             include_metadata: bool = True
         ) -> Dict:
 
@@ -170,37 +176,13 @@ class PersonalizeResolver():
             'inputList': input_list
         }
 
-        is_recommender = arn.split(':')[5].startswith('recommender/')
-        if is_recommender:
-            params['recommenderArn'] = arn
-        else:
-            params['campaignArn'] = arn
-
-        if filter_arn:
-            params['filterArn'] = filter_arn
-            if filter_values:
-                if isinstance(filter_values, str):
-                    filter_values = json.loads(filter_values)
-                params['filterValues'] = filter_values
-
-        if context:
-            if isinstance(context, str):
-                context = json.loads(context)
-            params['context'] = context
-
-        metadata_config = variation_config.get('inferenceItemMetadata')
-        if include_metadata and metadata_config and metadata_config.get('type') == 'personalize':
-            item_columns = metadata_config.get('itemColumns')
-            params['metadataColumns'] = {
-                'ITEMS': item_columns
-            }
+        self._augment_params(params, variation_config, arn, filter_arn, filter_values, context, include_metadata)
 
         logger.debug('Calling personalize.get_personalized_ranking() with arguments: %s', params)
 
         try:
             response = self.personalize_runtime.get_personalized_ranking(**params)
             logger.debug(response)
-            del response['ResponseMetadata']
         except ClientError as e:
             if e.response['Error']['Code'] == 'ThrottlingException':
                 metrics.add_dimension(name="Arn", value=arn)
@@ -8,23 +8,32 @@ Personalization response decorators
 import boto3
 import botocore
 import os
+import functools
+import random
 import time
-import math
 import dbm
-import json
+import orjson
 import gzip
 import shutil
 
 from typing import Any, Dict, List
 from http import HTTPStatus
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger, Tracer, Metrics
 from aws_lambda_powertools.metrics import MetricUnit
 from personalization_error import ConfigError, DynamoDbError
 from personalization_constants import LOCAL_DB_FILENAME, LOCAL_DB_GZIP_FILENAME
 from background_tasks import BackgroundTasks
+from util import ADAPTIVE_RETRIES
+
+try:
+    import dbm.gnu as dbm_gnu
+except ImportError:
+    dbm_gnu = None
 
 tracer = Tracer()
 logger = Logger(child=True)
@@ -34,17 +43,48 @@ metrics = Metrics()
 table_name_prefix = os.environ.get('ItemsTableNamePrefix', 'PersonalizationApiItemMetadata_')
 primary_key_name = os.environ.get('ItemsTablePrimaryKeyFieldName', 'id')
 
+# Clients are only created when a namespace uses the datastore and are then shared by all decorators (and threads) so TLS
+# sessions are established once per container and kept alive between bursts.
+client_config = Config(tcp_keepalive = True, max_pool_connections = 50, retries = ADAPTIVE_RETRIES)
+
+@functools.cache
+def get_s3_client():
+    return boto3.client('s3', config = client_config)
+
+@functools.cache
+def get_dynamodb_client():
+    # Metadata lookups are on the request path so they fail fast rather than waiting out the default 60s timeout.
+    return boto3.client('dynamodb', config = client_config.merge(Config(connect_timeout = 0.3, read_timeout = 2.5)))
+
+# Only the item attributes map is deserialized; keys are sent and read in their low-level form ({'S': ...}).
+deserialize = TypeDeserializer().deserialize
+
+# Chunked metadata lookups run on a pool owned by this module for the lifetime of the container (avoids creating
+# and joining threads on every request).
+decorate_pool = ThreadPoolExecutor(max_workers = int(os.environ.get('DECORATE_WORKERS', '8')), thread_name_prefix = 'ddb-dec')
+
 PREPARE_CHECK_FREQUENCY = 5 # 5 seconds
 DEFAULT_LOCALDB_DOWNLOAD_FREQ = 300 # 5 minutes
+LOCALDB_CACHE_MAX_SIZE = 10000 # Parsed metadata items cached per localdb decorator
 class ResponseDecorator(ABC):
     _decorators: Dict[str, Any] = {}
     _last_prepare_check = 0
     _last_localdb_download_attempt = {}
+    _warmed_namespaces = set()
 
     @abstractmethod
-    def decorate(self, response: Dict) -> Dict:
+    def decorate(self, response: Dict, items_key_name: str = None) -> Dict:
         pass
 
+    @staticmethod
+    def _items_key_name(response: Dict, items_key_name: str = None) -> str:
+        """ Returns the name of the item list property in the response, detecting it when not provided by the caller """
+        if not items_key_name:
+            items_key_name = 'itemList' if 'itemList' in response else 'personalizedRanking'
+        if not items_key_name in response:
+            raise ValueError(f'Response is missing "{items_key_name}" property')
+        return items_key_name
+
     def close(self):
         pass
 
@@ -56,6 +96,7 @@ class ResponseDecorator(ABC):
             bucket = os.environ['StagingBucket']
 
             prepared_count = 0
+            initial_downloads: List[Future] = []
 
             for namespace, namespace_config in config['namespaces'].items():
                 metadata_config = namespace_config.get('inferenceItemMetadata')
@@ -69,18 +110,31 @@ class ResponseDecorator(ABC):
 
                     if start - ResponseDecorator._last_localdb_download_attempt.get(namespace, 0) > sync_interval:
                         ResponseDecorator._last_localdb_download_attempt[namespace] = time.time()
-                        background.submit(ResponseDecorator._download_localdb, namespace = namespace, bucket = bucket)
+                        # Clients are created on the calling thread since creating them from the default session is
+                        # not thread-safe.
+                        future = background.submit_detached(ResponseDecorator._download_localdb, namespace = namespace, bucket = bucket, s3 = get_s3_client())
+                        if not os.path.isfile(localdb_path(namespace)):
+                            initial_downloads.append(future)
                         prepared_count += 1
                     else:
                         logger.debug('Localdb inference metadata sync check for namespace %s not due yet', namespace)
 
                 elif type == 'dynamodb':
-                    ResponseDecorator._decorators[namespace] = DynamoDbResponseDecorator(table_name_prefix + namespace, primary_key_name)
+                    decorator = DynamoDbResponseDecorator(table_name_prefix + namespace, primary_key_name)
+                    ResponseDecorator._decorators[namespace] = decorator
+                    if namespace not in ResponseDecorator._warmed_namespaces:
+                        ResponseDecorator._warmed_namespaces.add(namespace)
+                        background.submit_detached(decorator.warm, get_dynamodb_client())
                     prepared_count += 1
 
                 elif type == 'personalize':
                     logger.debug('Personalize inference metadata does not require preparation')
 
+            if initial_downloads:
+                # Nothing to decorate from until the initial downloads complete (e.g. on a cold start) so wait for them
+                # (concurrently). Only refreshes of an existing localdb are left in the background.
+                wait(initial_downloads)
+
             ResponseDecorator._last_prepare_check = prepare_done = time.time()
 
             if prepared_count > 0:
@@ -119,22 +173,25 @@ class ResponseDecorator(ABC):
     @staticmethod
     def _download_localdb(namespace: str, bucket: str, s3: Any = None):
         if not s3:
-            s3 = boto3.client('s3')
+            s3 = get_s3_client()
 
-        local_dir = f'/tmp/{namespace}'
+        local_file = localdb_path(namespace)
+        local_dir = os.path.dirname(local_file)
         if not os.path.isdir(local_dir):
             os.makedirs(local_dir)
 
-        local_file = f'{local_dir}/{LOCAL_DB_FILENAME}'
-
         key = f'localdbs/{namespace}/{LOCAL_DB_GZIP_FILENAME}'
 
         logger.info('Downloading s3://%s/%s and uncompressing to %s', bucket, key, local_file)
         try:
             response = s3.get_object(Bucket = bucket, Key = key)
             stream = gzip.GzipFile(None, 'rb', fileobj = response['Body'])
-            with open(local_file, 'wb') as out:
+            # Uncompress to a temporary file and then atomically replace the localdb so that the file the current
+            # decorator has open (and mapped) is never overwritten underneath it.
+            download_file = f'{local_file}.download'
+            with open(download_file, 'wb') as out:
                 shutil.copyfileobj(stream, out)
+            os.replace(download_file, local_file)
 
             old_decorator = ResponseDecorator._decorators.get(namespace)
             ResponseDecorator._decorators[namespace] = LocalDbResponseDecorator(namespace)
@@ -147,14 +204,30 @@ class ResponseDecorator(ABC):
             else:
                 raise e
 
+def localdb_path(namespace: str) -> str:
+    """ Returns the path of the local copy of a namespace's localdb file """
+    return f'/tmp/{namespace}/{LOCAL_DB_FILENAME}'
+
+def open_localdb(path: str) -> Any:
+    """ Opens a localdb file for reading
+
+    GNU dbm files (what the item metadata loader builds when the gnu module is available) are opened without
+    locking since they are only ever replaced, never updated in place. Other dbm formats fall back to dbm.open().
+    """
+    if dbm_gnu and dbm.whichdb(path) == 'dbm.gnu':
+        return dbm_gnu.open(path, 'ru')
+    return dbm.open(path, 'r')
+
 class LocalDbResponseDecorator(ResponseDecorator):
     def __init__(self, namespace: str):
         self.namespace = namespace
-        self.local_file = f'/tmp/{self.namespace}/{LOCAL_DB_FILENAME}'
+        self.local_file = localdb_path(namespace)
         if os.path.isfile(self.local_file):
-            self.dbm_file = dbm.open(self.local_file, 'r')
+            self.dbm_file = open_localdb(self.local_file)
         else:
             self.dbm_file = None
+        # Parsed item metadata is cached per instance; a new instance (and cache) is created when the localdb is re-downloaded.
+        self._items: Dict[str, Dict] = {}
 
     def __del__(self):
         self.close()
@@ -167,114 +240,141 @@ class LocalDbResponseDecorator(ResponseDecorator):
             pass
         self.dbm = None
 
+    def _get_item(self, id: str) -> Dict:
+        """ Returns the parsed metadata for an item from the cache or localdb (cached values must not be modified) """
+        if id in self._items:
+            return self._items[id]
+
+        s = self.dbm_file.get(id)
+        item = orjson.loads(s) if s else None
+
+        if len(self._items) >= LOCALDB_CACHE_MAX_SIZE:
+            self._items.clear()
+        self._items[id] = item
+        return item
+
     @tracer.capture_method
-    def decorate(self, response: Dict):
+    def decorate(self, response: Dict, items_key_name: str = None):
         if not self.dbm_file and os.path.isfile(self.local_file):
-            self.dbm_file = dbm.open(self.local_file, 'r')
+            self.dbm_file = open_localdb(self.local_file)
 
         if self.dbm_file:
             # Create lookup dictionary so results from DDB can be efficiently merged into response.
             lookup: Dict[str, List[int]] = {}
-            items_key_name = 'itemList' if 'itemList' in response else 'personalizedRanking'
-            if not items_key_name in response:
-                raise ValueError(f'Response is missing "{items_key_name}" property')
+            items = response[self._items_key_name(response, items_key_name)]
+            if not items:
+                return
 
-            for idx,item in enumerate(response[items_key_name]):
+            for idx,item in enumerate(items):
                 lookup.setdefault(item['itemId'], []).append(idx)
 
-            unique_items = list(lookup.keys())
-
-            def get_item(id):
-                s = self.dbm_file.get(id)
-                return json.loads(s) if s else s
-
-            for id in unique_items:
-                item = get_item(id)
+            # Lookups are served from the parsed item cache or a local (mapped) file read, which hold the GIL and
+            # complete in microseconds, so they are done in a single pass rather than fanned out to threads.
+            for id, idxs in lookup.items():
+                item = self._get_item(id)
                 if item:
-                    for idx in lookup[id]:
-                        response[items_key_name][idx]['metadata'] = item
+                    # Each response item gets its own copy so changes to a response never reach the cache.
+                    for idx in idxs:
+                        items[idx]['metadata'] = dict(item)
         else:
             logger.error('Local DB file %s does not exist on local disk. Has item metadata been uploaded and staged in S3?', self.local_file)
 
 class DynamoDbResponseDecorator(ResponseDecorator):
-    MAX_BATCH_SIZE = 50
-    __dynamodb = boto3.resource('dynamodb')
+    MAX_BATCH_SIZE = 100 # BatchGetItem maximum keys per request
+    # Throttling error codes that are surfaced to the caller as 429s.
+    LIMIT_EXCEEDED_ERROR_CODES = frozenset({
+        'ProvisionedThroughputExceededException',
+        'RequestLimitExceeded',
+        'LimitExceededException'
+    })
 
     def __init__(self, table_name: str, primary_key_name: str):
         self.table_name = table_name
         self.primary_key_name = primary_key_name
 
     @tracer.capture_method
-    def decorate(self, response: Dict):
+    def decorate(self, response: Dict, items_key_name: str = None):
         try:
-            self._decorate(response)
-        except DynamoDbResponseDecorator.__dynamodb.meta.client.exceptions.LimitExceedException as e:
-            metrics.add_metric(name="DynamoDBLimitExceed", unit=MetricUnit.Count, value=1)
-            raise DynamoDbError(
-                    HTTPStatus.TOO_MANY_REQUESTS,
-                    e.response['Error']['Code'],
-                    e.response['Error']['Message'],
-                    e.response['ResponseMetadata']['HTTPStatusCode']
-            )
+            self._decorate(response, items_key_name)
         except botocore.exceptions.ClientError as e:
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            if e.response['Error']['Code'] in self.LIMIT_EXCEEDED_ERROR_CODES:
+                metrics.add_metric(name="DynamoDBLimitExceed", unit=MetricUnit.Count, value=1)
+                status = HTTPStatus.TOO_MANY_REQUESTS
+
             raise DynamoDbError(
-                    HTTPStatus.INTERNAL_SERVER_ERROR,
+                    status,
                     e.response['Error']['Code'],
                     e.response['Error']['Message'],
                     e.response['ResponseMetadata']['HTTPStatusCode']
             )
 
-    def _decorate(self, response: Dict):
-        items_key_name = 'itemList' if 'itemList' in response else 'personalizedRanking'
-        if not items_key_name in response:
-            raise ValueError(f'Response is missing "{items_key_name}" property')
+    def _decorate(self, response: Dict, items_key_name: str = None):
+        items = response[self._items_key_name(response, items_key_name)]
+        if not items:
+            # Nothing to look up (and DynamoDB rejects a batch without keys).
+            return
 
         # Create lookup dictionary so results from DDB can be efficiently merged into response.
         lookup = {}
-        for idx,item in enumerate(response[items_key_name]):
+        for idx,item in enumerate(items):
             lookup.setdefault(item['itemId'], []).append(idx)
 
         unique_items = list(lookup.keys())
 
-        if len(unique_items) > self.MAX_BATCH_SIZE:
-            chunk_size = int(math.ceil(len(unique_items) / math.ceil(len(unique_items)/self.MAX_BATCH_SIZE)))
+        item_count = len(unique_items)
+        if item_count > self.MAX_BATCH_SIZE:
+            # Spread the items evenly over the fewest chunks (ceiling division in integer arithmetic).
+            chunk_count = -(-item_count // self.MAX_BATCH_SIZE)
+            chunk_size = -(-item_count // chunk_count)
 
-            item_chunks = [unique_items[i:i + chunk_size] for i in range(0, len(unique_items), chunk_size)]
+            item_chunks = [unique_items[i:i + chunk_size] for i in range(0, item_count, chunk_size)]
 
             logger.debug('Launching %d background threads to lookup metadata for %d unique items in chunks of max %d',
-                    len(item_chunks), len(unique_items), chunk_size)
-
-            with ThreadPoolExecutor() as executor:
-                futures: Future = []
-                for item_ids in item_chunks:
-                    batch_keys = {
-                        self.table_name: {
-                            'Keys': [{self.primary_key_name: item_id} for item_id in item_ids]
-                        }
-                    }
-
-                    futures.append(
-                        executor.submit(self._batch_get, None, batch_keys)
-                    )
-
-                for future in as_completed(futures):
-                    retrieved = future.result()
-                    # Decorate each item with a "metadata" field containing info from DDB.
-                    for ddb_item in retrieved[self.table_name]:
-                        for idx in lookup[ddb_item[self.primary_key_name]]:
-                            response[items_key_name][idx]['metadata'] = ddb_item['attributes']
+                    len(item_chunks) - 1, item_count, chunk_size)
+
+            futures: List[Future] = []
+            for item_ids in item_chunks[1:]:
+                futures.append(
+                    decorate_pool.submit(self._batch_get, get_dynamodb_client(), self._batch_keys(item_ids))
+                )
+
+            # The first chunk is retrieved on the calling thread, overlapping with the chunks retrieved in the background.
+            retrieved = self._batch_get(get_dynamodb_client(), self._batch_keys(item_chunks[0]))
+            self._merge_metadata(retrieved, lookup, items)
+
+            for future in as_completed(futures):
+                self._merge_metadata(future.result(), lookup, items)
         else:
-            batch_keys = {
-                self.table_name: {
-                    'Keys': [{self.primary_key_name: item_id} for item_id in unique_items]
+            retrieved = self._batch_get(get_dynamodb_client(), self._batch_keys(unique_items))
+            self._merge_metadata(retrieved, lookup, items)
+
+    def warm(self, dynamodb):
+        """ Establishes a connection to DynamoDB ahead of the first lookup with a single (missing) key request """
+        try:
+            dynamodb.batch_get_item(RequestItems = self._batch_keys(['__warm__']))
+        except Exception as e:
+            logger.warning('Unable to warm DynamoDB connection for table %s: %s', self.table_name, e)
+
+    def _batch_keys(self, item_ids: List[str]) -> Dict:
+        """ Builds low-level batch_get_item request items that only project the primary key and item attributes """
+        return {
+            self.table_name: {
+                'Keys': [{self.primary_key_name: {'S': item_id}} for item_id in item_ids],
+                'ProjectionExpression': '#pk, #attributes',
+                'ExpressionAttributeNames': {
+                    '#pk': self.primary_key_name,
+                    '#attributes': 'attributes'
                 }
             }
+        }
 
-            retrieved = self._batch_get(DynamoDbResponseDecorator.__dynamodb, batch_keys)
-            # Decorate each item with a "metadata" field containing info from DDB.
-            for ddb_item in retrieved[self.table_name]:
-                for idx in lookup[ddb_item[self.primary_key_name]]:
-                    response[items_key_name][idx]['metadata'] = ddb_item['attributes']
+    def _merge_metadata(self, retrieved: Dict, lookup: Dict[str, List[int]], items: List[Dict]):
+        """ Decorates each item with a "metadata" field containing info from DDB """
+        for ddb_item in retrieved[self.table_name]:
+            metadata = deserialize(ddb_item['attributes'])
+            for idx in lookup[ddb_item[self.primary_key_name]['S']]:
+                items[idx]['metadata'] = metadata
 
     def _batch_get(self, dynamodb, batch_keys: Dict) -> Dict:
         """
@@ -282,22 +382,20 @@ class DynamoDbResponseDecorator(ResponseDecorator):
         more than one table.
 
         When Amazon DynamoDB cannot process all items in a batch, a set of unprocessed
-        keys is returned. This function uses an exponential backoff algorithm to retry
-        getting the unprocessed keys until all are retrieved or the specified
-        number of tries is reached.
+        keys is returned. This function uses an exponential backoff algorithm with full
+        jitter (so concurrent executions do not retry in lockstep) to retry getting the
+        unprocessed keys until all are retrieved or the specified number of tries is reached.
 
-        :param dynamodb: DynamoDB resource or None and one will be created (such as in thread)
+        :param dynamodb: DynamoDB (low-level) client, which is safe to share across threads
         :param batch_keys: The set of keys to retrieve. A batch can contain at most 100
                         keys. Otherwise, Amazon DynamoDB returns an error.
         :return: The dictionary of retrieved items grouped under their respective
                 table names.
         """
-        if not dynamodb:
-            dynamodb = boto3.resource('dynamodb')
-
         tries = 0
         max_tries = 3
-        sleep_millis = 250  # Start with 250ms of sleep, then exponentially increase.
+        base_sleep_millis = 250  # Sleep up to 250ms, then exponentially increase the cap.
+        max_sleep_millis = 1500
         retrieved = {key: [] for key in batch_keys}
         while tries < max_tries:
             response = dynamodb.batch_get_item(RequestItems=batch_keys)
@@ -310,13 +408,13 @@ class DynamoDbResponseDecorator(ResponseDecorator):
             if len(unprocessed) > 0:
                 batch_keys = unprocessed
                 unprocessed_count = sum([len(batch_key['Keys']) for batch_key in batch_keys.values()])
-                logger.warn('%s unprocessed keys returned. Sleeping for %sms, then will retry', unprocessed_count, sleep_millis)
+                logger.warn('%s unprocessed keys returned; will retry', unprocessed_count)
 
                 tries += 1
                 if tries < max_tries:
-                    logger.info('Sleeping for %sms', sleep_millis)
+                    sleep_millis = random.uniform(0, min(max_sleep_millis, base_sleep_millis * (2 ** (tries - 1))))
+                    logger.info('Sleeping for %0.0fms', sleep_millis)
                     time.sleep(sleep_millis / 1000.0)
-                    sleep_millis = min(sleep_millis * 2, 1500)
             else:
                 break
 
@@ -327,6 +425,6 @@ class PersonalizeResponseDecorator(ResponseDecorator):
         self.namespace = namespace
 
     @tracer.capture_method
-    def decorate(self, response: Dict):
+    def decorate(self, response: Dict, items_key_name: str = None):
         # Nothing to do since Personalize already returns "metadata" for each item
         pass
\ No newline at end of file
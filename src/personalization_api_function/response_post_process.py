@@ -4,33 +4,40 @@
 """ AWS Lambda response post processor """
 
 import boto3
-import json
-import codecs
+import functools
+import orjson
 
 from typing import Dict
 from http import HTTPStatus
+from botocore.config import Config
 from aws_lambda_powertools import Logger, Tracer
 from personalization_error import LambdaError
 from personalization_constants import ACTION_RECOMMEND_ITEMS, ACTION_RELATED_ITEMS, ACTION_RERANK_ITEMS
+from util import ADAPTIVE_RETRIES, compat_default
 
 tracer = Tracer()
 logger = Logger(child=True)
 
 PAYLOAD_VERSION = '1.0'
 
+@functools.cache
+def get_lambda_client():
+    """ Returns the Lambda client, created on first use and then shared so TLS sessions are kept alive between bursts """
+    return boto3.client('lambda', config = Config(tcp_keepalive = True, max_pool_connections = 50, retries = ADAPTIVE_RETRIES, connect_timeout = 0.3))
+
 class PostProcessor():
     def __init__(
         self,
-        lambda_client = boto3.client('lambda')
+        lambda_client = None
     ):
-        self.lambda_client = lambda_client
+        self.lambda_client = lambda_client or get_lambda_client()
 
     def _invoke_function(self, arn: str, payload: Dict) -> Dict:
         response = self.lambda_client.invoke(
             FunctionName = arn,
             InvocationType = 'RequestResponse',
-            LogType = 'Tail', #'None'|'Tail',
-            Payload = codecs.encode(json.dumps(payload))
+            LogType = 'None', #'None'|'Tail' (tail logs are never read)
+            Payload = orjson.dumps(payload, default=compat_default)
         )
 
         logger.debug(response)
@@ -39,7 +46,7 @@ class PostProcessor():
         if status != HTTPStatus.OK:
             raise LambdaError(status, 'FunctionInvokeError', response.get('FunctionError'))
 
-        return json.load(response.get('Payload'))
+        return orjson.loads(response['Payload'].read())
 
     @tracer.capture_method
     def process_recommend_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, user_id: str, response: Dict) -> Dict:
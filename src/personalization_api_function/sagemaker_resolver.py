@@ -4,43 +4,130 @@
 """ Amazon SageMaker resolver that invokes an inference endpoint for a SageMaker model """
 
 import boto3
-import json
-import codecs
+import functools
+import orjson
 
-from typing import Dict, List, Union
+from typing import Dict, List, Set, Tuple, Union
 from http import HTTPStatus
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from aws_lambda_powertools import Logger, Tracer
 from personalization_error import SageMakerError
 from personalization_constants import ACTION_RECOMMEND_ITEMS, ACTION_RELATED_ITEMS, ACTION_RERANK_ITEMS
+from util import ADAPTIVE_RETRIES, compat_default
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 tracer = Tracer()
 logger = Logger(child=True)
 
 PAYLOAD_VERSION = '1.0'
 
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+
+@functools.cache
+def get_sagemaker_runtime():
+    """ Returns the SageMaker runtime client, created on first use and then shared so TLS sessions are kept alive between bursts """
+    return boto3.client('sagemaker-runtime', config = Config(
+        tcp_keepalive = True,
+        max_pool_connections = 64,
+        retries = ADAPTIVE_RETRIES,
+        connect_timeout = 1.0,
+        read_timeout = 5.0
+    ))
+
 class SageMakerResolver():
     def __init__(
         self,
-        sagemaker = boto3.client('sagemaker-runtime')
+        sagemaker = None
     ):
-        self.sagemaker = sagemaker
+        self.sagemaker = sagemaker or get_sagemaker_runtime()
+        self._templates: Dict[Tuple, Tuple] = {}
+        self._non_streaming_endpoints: Set[str] = set()
+
+    def _payload_template(self, endpoint_name: str, action: str, recommender_path: str, recommender_config: Dict, variation_config: Dict) -> Tuple[Dict, bytes]:
+        """ Returns the invariant portion of the endpoint payload for a recommender/variation and its JSON serialization
+
+        The serialized template is a JSON object with its closing brace replaced by a comma so that request specific fields can be appended.
+        Templates are rebuilt only when the config objects they reference are replaced (i.e. after a config refresh).
+        """
+        key = (endpoint_name, action, recommender_path)
+        template = self._templates.get(key)
+        if not template or template[0] is not recommender_config or template[1] is not variation_config:
+            payload = {
+                'version': PAYLOAD_VERSION,
+                'action': action,
+                'recommender': {
+                    'path': recommender_path,
+                    'config': recommender_config
+                },
+                'variation': variation_config
+            }
+            template = (recommender_config, variation_config, (payload, orjson.dumps(payload, default=compat_default)[:-1] + b','))
+            self._templates[key] = template
+
+        return template[2]
+
+    def _invoke_endpoint_stream(self, endpoint_name: str, content_type: str, body: bytes) -> bytes:
+        """ Invokes the endpoint with a streamed response and returns the joined payload parts
+
+        Returns None if the endpoint does not support response streaming so the caller can fall back to invoke_endpoint.
+        """
+        try:
+            response = self.sagemaker.invoke_endpoint_with_response_stream(
+                EndpointName = endpoint_name,
+                ContentType = content_type,
+                Accept = content_type,
+                Body = body
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            logger.warning('Endpoint %s does not support response streaming; falling back to non-streaming invocation: %s', endpoint_name, e)
+            self._non_streaming_endpoints.add(endpoint_name)
+            return None
+
+        return b''.join(event['PayloadPart']['Bytes'] for event in response['Body'] if 'PayloadPart' in event)
+
+    def _invoke_endpoint(self, endpoint_name: str, variation_config: Dict, template: Tuple[Dict, bytes], context: Dict, payload: Dict) -> Dict:
+        content_type = variation_config.get('contentType', CONTENT_TYPE_JSON)
 
-    def _invoke_endpoint(self, endpoint_name: str, context: Dict, payload: Dict) -> Dict:
         if context:
-            if isinstance(context, str):
-                context = json.loads(context)
+            if isinstance(context, (str, bytes)):
+                context = orjson.loads(context)
             payload['context'] = context
 
-        response = self.sagemaker.invoke_endpoint(
-            EndpointName = endpoint_name,
-            ContentType = 'application/json',
-            Accept = 'application/json',
-            Body = codecs.encode(json.dumps(payload))
-        )
+        if content_type == CONTENT_TYPE_MSGPACK:
+            if not msgpack:
+                raise SageMakerError(HTTPStatus.INTERNAL_SERVER_ERROR, 'MessagePackNotAvailable', 'Variation content type is MessagePack but the msgpack package is not installed')
+            body = msgpack.packb({**template[0], **payload}, use_bin_type=True, default=compat_default)
+        else:
+            # Splice the request specific fields into the pre-serialized template: b'{...template,' + b'"userId":...}'
+            body = template[1] + orjson.dumps(payload, default=compat_default)[1:]
+
+        response_body = None
+        if variation_config.get('responseStream') and endpoint_name not in self._non_streaming_endpoints:
+            response_body = self._invoke_endpoint_stream(endpoint_name, content_type, body)
+
+        if response_body is None:
+            response = self.sagemaker.invoke_endpoint(
+                EndpointName = endpoint_name,
+                ContentType = content_type,
+                Accept = content_type,
+                Body = body
+            )
+
+            logger.debug(response)
+            response_body = response['Body'].read()
 
-        logger.debug(response)
+        if content_type == CONTENT_TYPE_MSGPACK:
+            return msgpack.unpackb(response_body, raw=False)
 
-        return json.load(response.get('Body'))
+        return orjson.loads(response_body)
 
     @tracer.capture_method
     def get_recommend_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, user_id: str, num_results: int = 25, context: Union[str,Dict] = None) -> Dict:
@@ -50,19 +137,13 @@ class SageMakerResolver():
 
         logger.debug('Invoking SageMaker endpoint %s for recommend-items recommendation type', endpoint_name)
 
+        template = self._payload_template(endpoint_name, ACTION_RECOMMEND_ITEMS, recommender_path, recommender_config, variation_config)
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RECOMMEND_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
             'userId': user_id,
             'numResults': num_results
         }
 
-        return self._invoke_endpoint(endpoint_name, context, payload)
+        return self._invoke_endpoint(endpoint_name, variation_config, template, context, payload)
 
     @tracer.capture_method
     def get_related_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, item_id: str, num_results: int = 25, user_id: str = None, context: Union[str,Dict] = None) -> Dict:
@@ -72,20 +153,14 @@ class SageMakerResolver():
 
         logger.debug('Invoking SageMaker endpoint %s for related-items recommendation type', endpoint_name)
 
+        template = self._payload_template(endpoint_name, ACTION_RELATED_ITEMS, recommender_path, recommender_config, variation_config)
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RELATED_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
             'itemId': item_id,
             'userId': (user_id if user_id else ''),
             'numResults': num_results
         }
 
-        return self._invoke_endpoint(endpoint_name, context, payload)
+        return self._invoke_endpoint(endpoint_name, variation_config, template, context, payload)
 
     @tracer.capture_method
     def rerank_items(self, recommender_path: str, recommender_config: Dict, variation_config: Dict, user_id: str, input_list: List[str], context: Union[str,Dict] = None) -> Dict:
@@ -95,16 +170,10 @@ class SageMakerResolver():
 
         logger.debug('Invoking SageMaker endpoint %s for rerank-items recommendation type', endpoint_name)
 
+        template = self._payload_template(endpoint_name, ACTION_RERANK_ITEMS, recommender_path, recommender_config, variation_config)
         payload = {
-            'version': PAYLOAD_VERSION,
-            'action': ACTION_RERANK_ITEMS,
-            'recommender': {
-                'path': recommender_path,
-                'config': recommender_config
-            },
-            'variation': variation_config,
             'userId': user_id,
             'itemList': input_list
         }
 
-        return self._invoke_endpoint(endpoint_name, context, payload)
+        return self._invoke_endpoint(endpoint_name, variation_config, template, context, payload)
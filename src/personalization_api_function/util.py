@@ -1,8 +1,19 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import os
 import json
 import decimal
+import functools
+import hashlib
+import random
+import threading
+import time
+import orjson
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+from aws_lambda_powertools import Tracer
 
 class CompatEncoder(json.JSONEncoder):
     """ Compatibility encoder that supports Decimal type
@@ -11,9 +22,106 @@ class CompatEncoder(json.JSONEncoder):
     """
     def default(self, obj):
         if isinstance(obj, decimal.Decimal):
-            if obj % 1 > 0:
-                return float(obj)
-            else:
-                return int(obj)
+            return compat_default(obj)
         else:
             return super(CompatEncoder, self).default(obj)
+
+# Adaptive retries rate limit on the client side when a service throttles, rather than retrying in lockstep
+# with every other concurrent execution and amplifying the throttling.
+ADAPTIVE_RETRIES = {'mode': 'adaptive', 'max_attempts': 5}
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TraceSampleRate', '0.05'))
+
+CONFIG_HASH_MAX_SIZE = 256
+
+_config_hashes: Dict[int, tuple] = {}
+
+def config_hash(config: Dict) -> int:
+    """ Returns a stable 64-bit hash of a configuration dictionary that is suitable for use in cache keys
+
+    Configuration dictionaries are replaced rather than mutated when the configuration is refreshed so
+    hashes are memoized on object identity. A reference to the config is held alongside its hash so the
+    id cannot be reused by another object while the entry exists.
+    """
+    entry = _config_hashes.get(id(config))
+    if entry is not None and entry[0] is config:
+        return entry[1]
+
+    if len(_config_hashes) >= CONFIG_HASH_MAX_SIZE:
+        _config_hashes.clear()
+
+    digest = hashlib.blake2b(orjson.dumps(config, default=compat_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS), digest_size=8).digest()
+    value = int.from_bytes(digest, 'big')
+    _config_hashes[id(config)] = (config, value)
+    return value
+
+def compat_default(obj):
+    """ Compatibility default function for orjson that supports Decimal type
+    Usage:
+    orjson.dumps(data, default=compat_default)
+    """
+    if isinstance(obj, decimal.Decimal):
+        # Integral values (including ones with trailing zeros such as 1.0) are serialized as ints. Special values
+        # (NaN/Infinity) cannot be converted to ints and are returned as floats.
+        return int(obj) if obj.is_finite() and obj == obj.to_integral_value() else float(obj)
+    raise TypeError
+
+class TTLCache():
+    """ Bounded, thread-safe in-memory cache where entries expire a fixed number of seconds after being put
+    Usage:
+    cache = TTLCache(maxsize=1000, ttl=5)
+    cache.put(key, value)
+    value = cache.get(key)
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            now = time.monotonic()
+            # Entries are kept in the order they were put and all have the same ttl, so expired entries are always at
+            # the front. They are purged here so that they do not linger in memory until the cache is full.
+            entries = self._entries
+            while entries and next(iter(entries.values()))[0] < now:
+                entries.popitem(last=False)
+
+            entries[key] = (now + self.ttl, value)
+            entries.move_to_end(key)
+            # Evict oldest entries first once the cache is full.
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+def sampled_capture_method(tracer: Tracer, sample_rate: float = TRACE_SAMPLE_RATE) -> Callable:
+    """ Decorator that captures a method in an X-Ray subsegment for only a sample of calls
+    Usage:
+    @sampled_capture_method(tracer)
+    def method(self, ...):
+    """
+    def decorator(fn: Callable) -> Callable:
+        traced = tracer.capture_method(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if sample_rate >= 1 or random.random() < sample_rate:
+                return traced(*args, **kwargs)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -4,8 +4,8 @@
 import boto3
 import json
 import os
-from typing import Dict, List, Tuple
-from jsonpath_ng import parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
 from aws_lambda_powertools import Logger, Tracer
 
 tracer = Tracer()
@@ -25,6 +25,73 @@ APIGW_ROOT_PATHS = {
     'rerank-items': '/~1rerank-items~1{namespace}~1{recommender}~1{userId}~1{itemIds}/GET'
 }
 
+# Stage patch operation paths per type are formatted once rather than on every sync.
+APIGW_CACHING_ENABLED_PATHS = {type: f'{root_path}/caching/enabled' for type, root_path in APIGW_ROOT_PATHS.items()}
+APIGW_CACHING_TTL_PATHS = {type: f'{root_path}/caching/ttlInSeconds' for type, root_path in APIGW_ROOT_PATHS.items()}
+
+def iter_by_key(node, key: str) -> Iterator:
+    """ Yields every value for key at any depth below node (equivalent to the JSONPath $..<key>) """
+    if isinstance(node, dict):
+        for child_key, value in node.items():
+            if child_key == key:
+                yield value
+            yield from iter_by_key(value, key)
+    elif isinstance(node, list):
+        for value in node:
+            yield from iter_by_key(value, key)
+
+def find_max_ages(node) -> Iterator:
+    """ Yields every maxAge value at any depth below node """
+    return iter_by_key(node, 'maxAge')
+
+def find_cache_controls(node) -> Iterator[Dict]:
+    """ Yields every cacheControl object at any depth below node """
+    return (cache_control for cache_control in iter_by_key(node, 'cacheControl') if isinstance(cache_control, dict))
+
+def find_auto_context_rules(node) -> Iterator[Dict]:
+    """ Yields every rule of every autoContext below node (equivalent to the JSONPath $..autoContext..rules[*]) """
+    for auto_context in iter_by_key(node, 'autoContext'):
+        for rules in iter_by_key(auto_context, 'rules'):
+            for rule in (rules if isinstance(rules, list) else [rules]):
+                if isinstance(rule, dict):
+                    yield rule
+
+def walk_recommender_cache_controls(node, on_cache_control: Callable[[str, List], None], type: str = None):
+    """ Walks the configuration once, calling on_cache_control(type, max_ages) for every cacheControl below a recommenders.<type> node """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if type and key == 'cacheControl':
+                on_cache_control(type, list(find_max_ages(value)))
+            elif key == 'recommenders' and isinstance(value, dict):
+                for recommender_type, recommenders in value.items():
+                    walk_recommender_cache_controls(recommenders, on_cache_control, recommender_type if recommender_type in APIGW_ROOT_PATHS else type)
+            else:
+                walk_recommender_cache_controls(value, on_cache_control, type)
+    elif isinstance(node, list):
+        for value in node:
+            walk_recommender_cache_controls(value, on_cache_control, type)
+
+def current_stage_patch_values(stage: Dict) -> Dict[str, str]:
+    """ Returns the current stage settings keyed by the patch operation paths used to update them """
+    values = {
+        '/cacheClusterEnabled': 'true' if stage.get('cacheClusterEnabled') else 'false'
+    }
+    if stage.get('cacheClusterSize'):
+        values['/cacheClusterSize'] = stage['cacheClusterSize']
+
+    method_settings = stage.get('methodSettings', {})
+    for type, root_path in APIGW_ROOT_PATHS.items():
+        # Method settings are keyed by the resource path and method without the leading slash.
+        settings = method_settings.get(root_path[1:])
+        if not settings:
+            continue
+        if 'cachingEnabled' in settings:
+            values[APIGW_CACHING_ENABLED_PATHS[type]] = 'true' if settings['cachingEnabled'] else 'false'
+        if 'cacheTtlInSeconds' in settings:
+            values[APIGW_CACHING_TTL_PATHS[type]] = str(settings['cacheTtlInSeconds'])
+
+    return values
+
 @tracer.capture_method
 def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers: List[str]):
     # Get current stage settings to determine cache cluster settings.
@@ -36,6 +103,7 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
     cache_cluster_current_enabled = response['cacheClusterEnabled']
     cache_cluster_size = response['cacheClusterSize']
     cache_cluster_status = response['cacheClusterStatus']
+    current_settings = current_stage_patch_values(response)
 
     logger.info('Current APIGW cache cluster settings: enabled = %s, size = %s, status = %s',
         cache_cluster_current_enabled, cache_cluster_size, cache_cluster_status)
@@ -47,8 +115,7 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
     }
 
     # Seed TTLs with the minimal value across root cache control
-    jsonpath_expr = parse('$.cacheControl..maxAge')
-    max_ages = [match.value for match in jsonpath_expr.find(personalization_config)]
+    max_ages = list(find_max_ages(personalization_config.get('cacheControl')))
     logger.info('Max ages for root cacheControl: %s', max_ages)
     if max_ages:
         for item in ttls.items():
@@ -56,22 +123,14 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
 
     logger.debug('TTLs after applying root cacheControl: %s', ttls)
 
-    for type in ttls.keys():
-        jsonpath_expr = parse(f'$..recommenders.{type}')
-        recommenders = [match.value for match in jsonpath_expr.find(personalization_config)]
-
-        for recommender in recommenders:
-            jsonpath_expr = parse('$..cacheControl')
-            cache_controls = [match.value for match in jsonpath_expr.find(recommender)]
-            logger.debug('cacheControls for recommender %s/%s: %s', type, recommender.keys(), cache_controls)
+    def apply_cache_control(type: str, max_ages: List):
+        logger.debug('maxAges for %s cacheControl: %s', type, max_ages)
+        if max_ages:
+            min_age = min(max_ages)
+            ttls[type] = min_age if not ttls[type] else min(min_age, ttls[type])
 
-            for cache_control in cache_controls:
-                jsonpath_expr = parse('$..maxAge')
-                max_ages = [match.value for match in jsonpath_expr.find(cache_control)]
-                if max_ages:
-                    for item in ttls.items():
-                        min_age = min(max_ages)
-                        ttls[type] = min_age if not ttls[type] else min(min_age, ttls[type])
+    # Single pass over the configuration rather than one JSONPath scan per type/recommender/cacheControl
+    walk_recommender_cache_controls(personalization_config, apply_cache_control)
 
     patch = []
 
@@ -85,17 +144,17 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
             cache_cluster_enabled = True
             patch.extend([{
                 'op': 'replace',
-                'path': f'{APIGW_ROOT_PATHS[type]}/caching/enabled',
+                'path': APIGW_CACHING_ENABLED_PATHS[type],
                 'value': 'true'
             },{
                 'op': 'replace',
-                'path': f'{APIGW_ROOT_PATHS[type]}/caching/ttlInSeconds',
+                'path': APIGW_CACHING_TTL_PATHS[type],
                 'value': f'{ttl}'
             }])
         else:
             patch.append({
                 'op': 'replace',
-                'path': f'{APIGW_ROOT_PATHS[type]}/caching/enabled',
+                'path': APIGW_CACHING_ENABLED_PATHS[type],
                 'value': 'false'
             })
 
@@ -116,15 +175,21 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
             'value': '1.6'
         })
 
+    # Only send operations that change the stage; the sync runs on every configuration deployment.
+    patch = [op for op in patch if current_settings.get(op['path']) != op['value']]
+
     logger.debug('APIGW patchOperations: %s', patch)
 
-    response = apigw.update_stage(
-        restApiId=REST_API_ID,
-        stageName=REST_API_STAGE,
-        patchOperations=patch
-    )
+    if patch:
+        response = apigw.update_stage(
+            restApiId=REST_API_ID,
+            stageName=REST_API_STAGE,
+            patchOperations=patch
+        )
 
-    logger.debug(json.dumps(response, indent=2, default=str))
+        logger.debug(json.dumps(response, indent=2, default=str))
+    else:
+        logger.info('Stage caching settings already match configuration; update of stage not required')
 
     response = apigw.get_resources(
         restApiId=REST_API_ID,
@@ -145,46 +210,48 @@ def update_apigw_rest_stage_caching(personalization_config: Dict, cache_headers:
         if item['path'] in paths_to_match:
             resource_ids.append(item['id'])
 
-    for resource_id in resource_ids:
-        response = apigw.get_integration(
-            restApiId=REST_API_ID,
-            resourceId=resource_id,
-            httpMethod='GET'
-        )
+    if resource_ids:
+        # Integrations are independent so their control plane round-trips are overlapped.
+        with ThreadPoolExecutor(max_workers = len(resource_ids)) as executor:
+            for future in [executor.submit(sync_integration_cache_keys, resource_id, cache_headers) for resource_id in resource_ids]:
+                future.result()
 
-        cache_keys = []
-        patch = []
+def sync_integration_cache_keys(resource_id: str, cache_headers: List[str]):
+    """ Updates the header cache key parameters of a resource's GET integration to match the cache headers """
+    response = apigw.get_integration(
+        restApiId=REST_API_ID,
+        resourceId=resource_id,
+        httpMethod='GET'
+    )
 
-        for cache_key in response['cacheKeyParameters']:
-            if not cache_key.startswith('method.request.header.'):
-                cache_keys.append(cache_key)
+    current_cache_keys = set(response.get('cacheKeyParameters', []))
+    cache_keys = set(cache_key for cache_key in current_cache_keys if not cache_key.startswith('method.request.header.'))
+    cache_keys.update(f'method.request.header.{cache_header}' for cache_header in cache_headers)
 
-        for cache_header in cache_headers:
-            cache_keys.append(f'method.request.header.{cache_header}')
+    patch = [{'op': 'remove', 'path': f'/cacheKeyParameters/{cache_key}'} for cache_key in sorted(current_cache_keys - cache_keys)]
+    patch.extend({'op': 'add', 'path': f'/cacheKeyParameters/{cache_key}'} for cache_key in sorted(cache_keys - current_cache_keys))
 
-        apigw.update_integration(
-            restApiId=REST_API_ID,
-            resourceId=resource_id,
-            httpMethod='GET',
-            patchOperations=[
-                {
-                    'op': 'add'|'remove'|'replace'|'move'|'copy'|'test',
-                    'path': 'string',
-                    'value': 'string',
-                    'from': 'string'
-                },
-            ]
-        )
+    if not patch:
+        logger.info('Integration cache keys for resource %s already match cache headers', resource_id)
+        return
+
+    logger.debug('APIGW integration patchOperations for resource %s: %s', resource_id, patch)
+
+    apigw.update_integration(
+        restApiId=REST_API_ID,
+        resourceId=resource_id,
+        httpMethod='GET',
+        patchOperations=patch
+    )
 
 @tracer.capture_method
 def determine_required_cloudfront_headers(personalization_config: Dict) -> Tuple[List, List]:
-    jsonpath_expr = parse('$..autoContext..rules[*].header')
-    auto_context_headers = [match.value for match in jsonpath_expr.find(personalization_config)]
+    auto_context_rules = list(find_auto_context_rules(personalization_config))
+    auto_context_headers = [rule['header'] for rule in auto_context_rules if 'header' in rule]
     origin_request_headers = set(i.lower() for i in auto_context_headers)
     cache_headers = set(origin_request_headers)
 
-    jsonpath_expr = parse('$..autoContext..rules[*].type')
-    auto_context_types = [match.value for match in jsonpath_expr.find(personalization_config)]
+    auto_context_types = [rule['type'] for rule in auto_context_rules if 'type' in rule]
     for type in auto_context_types:
         if type == 'season-of-year':
             # Latitude needed for North/South hemisphere. However, due to high variability in
@@ -203,7 +270,11 @@ def determine_required_cloudfront_headers(personalization_config: Dict) -> Tuple
     logger.info('Origin request headers: %s', origin_request_headers)
     logger.info('Cache headers: %s', cache_headers)
 
-    return list(origin_request_headers), list(cache_headers)
+    return sorted(origin_request_headers), sorted(cache_headers)
+
+def canonical_headers(headers: List[str]) -> List[str]:
+    """ Returns header names lowercased and sorted so header lists can be compared and stored in a stable order """
+    return sorted(header.lower() for header in headers)
 
 @tracer.capture_method
 def update_cloudfront_origin_request_policy(origin_request_headers: List[str]):
@@ -212,24 +283,25 @@ def update_cloudfront_origin_request_policy(origin_request_headers: List[str]):
     logger.debug(json.dumps(response, indent = 2, default=str))
 
     policy_config = response['OriginRequestPolicy']['OriginRequestPolicyConfig']
+    headers_config = policy_config['HeadersConfig']
 
     update_required = False
 
     if len(origin_request_headers) > 0:
-        update_required = (policy_config['HeadersConfig']['HeaderBehavior'] != 'whitelist' or
-                not policy_config['HeadersConfig'].get('Headers') or
-                not policy_config['HeadersConfig']['Headers'].get('Items') or
-                sorted(policy_config['HeadersConfig']['Headers']['Items'], key=str.lower) != sorted(origin_request_headers, key=str.lower))
-
-        policy_config['HeadersConfig']['HeaderBehavior'] = 'whitelist'
-        policy_config['HeadersConfig']['Headers'] = {
-            'Quantity': len(origin_request_headers),
-            'Items': origin_request_headers
+        # Compare and store headers in a canonical (lowercase, sorted) order so a policy written by a previous sync compares equal.
+        desired_headers = canonical_headers(origin_request_headers)
+        update_required = (headers_config['HeaderBehavior'] != 'whitelist' or
+                canonical_headers(headers_config.get('Headers', {}).get('Items', [])) != desired_headers)
+
+        headers_config['HeaderBehavior'] = 'whitelist'
+        headers_config['Headers'] = {
+            'Quantity': len(desired_headers),
+            'Items': desired_headers
         }
     else:
-        update_required = policy_config['HeadersConfig']['HeaderBehavior'] != 'none'
-        policy_config['HeadersConfig']['HeaderBehavior'] = 'none'
-        policy_config['HeadersConfig'].pop('Headers', None)
+        update_required = headers_config['HeaderBehavior'] != 'none'
+        headers_config['HeaderBehavior'] = 'none'
+        headers_config.pop('Headers', None)
 
     if update_required:
         logger.info('Updating CloudFront origin request policy %s', CLOUD_FRONT_ORIGIN_REQUEST_POLICY_ID)
@@ -244,8 +316,7 @@ def update_cloudfront_origin_request_policy(origin_request_headers: List[str]):
 
 @tracer.capture_method
 def update_cloudfront_cache_policy(personalization_config: Dict, cache_headers: List[str]):
-    jsonpath_expr = parse('$..cacheControl.*')
-    cache_controls = [match.value for match in jsonpath_expr.find(personalization_config)]
+    cache_controls = [value for cache_control in find_cache_controls(personalization_config) for value in cache_control.values()]
     logger.debug('cacheControl configs: %s', cache_controls)
 
     min_age = max_age = None
@@ -264,24 +335,24 @@ def update_cloudfront_cache_policy(personalization_config: Dict, cache_headers:
     logger.debug(json.dumps(response, indent = 2, default=str))
 
     policy_config = response['CachePolicy']['CachePolicyConfig']
+    headers_config = policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']
 
     update_required = False
 
     if len(cache_headers) > 0:
-        update_required = (policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['HeaderBehavior'] != 'whitelist' or
-                not policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig'].get('Headers') or
-                not policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['Headers'].get('Items') or
-                sorted(policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['Headers']['Items'], key=str.lower) != sorted(cache_headers, key=str.lower))
-
-        policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['HeaderBehavior'] = 'whitelist'
-        policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['Headers'] = {
-            'Quantity': len(cache_headers),
-            'Items': cache_headers
+        desired_headers = canonical_headers(cache_headers)
+        update_required = (headers_config['HeaderBehavior'] != 'whitelist' or
+                canonical_headers(headers_config.get('Headers', {}).get('Items', [])) != desired_headers)
+
+        headers_config['HeaderBehavior'] = 'whitelist'
+        headers_config['Headers'] = {
+            'Quantity': len(desired_headers),
+            'Items': desired_headers
         }
     else:
-        update_required = policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['HeaderBehavior'] != 'none'
-        policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig']['HeaderBehavior'] = 'none'
-        policy_config['ParametersInCacheKeyAndForwardedToOrigin']['HeadersConfig'].pop('Headers', None)
+        update_required = headers_config['HeaderBehavior'] != 'none'
+        headers_config['HeaderBehavior'] = 'none'
+        headers_config.pop('Headers', None)
 
     update_required = update_required or policy_config['MinTTL'] != min_age or policy_config['MaxTTL'] != max_age
 
@@ -307,8 +378,7 @@ def lambda_handler(event, _):
     logger.info(event)
 
     # Check the autoProvision flag on all cacheControl objects to make sure auto-provisioning is not disabled.
-    jsonpath_expr = parse('$..cacheControl[*].autoProvision')
-    auto_provision = [match.value for match in jsonpath_expr.find(event)]
+    auto_provision = [cache_control['autoProvision'] for cache_control in find_cache_controls(event) if 'autoProvision' in cache_control]
     logger.debug('cacheControl.autoProvision values: %s', auto_provision)
     if len(auto_provision) == 0 or not False in auto_provision:
         origin_request_headers, cache_headers = determine_required_cloudfront_headers(event)
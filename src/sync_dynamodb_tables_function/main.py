@@ -4,7 +4,8 @@
 import boto3
 import os
 
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
 from aws_lambda_powertools import Logger, Tracer
 
 tracer = Tracer()
@@ -15,28 +16,52 @@ dynamodb = boto3.resource('dynamodb')
 primary_key_name = os.environ.get('ItemsTablePrimaryKeyFieldName', 'id')
 table_name_prefix = os.environ.get('ItemsTableNamePrefix', 'PersonalizationApiItemMetadata_')
 
+SYNC_MAX_WORKERS = 16
+
 class ResourcePending(Exception):
     pass
 
 @tracer.capture_method
 def sync_tables(config: Dict) -> List[str]:
-    table_names = []
     namespaces = config.get('namespaces')
-    if namespaces:
-        for item in namespaces.items():
-            table_name = sync_table(item[0], item[1])
-            if table_name:
-                table_names.append(table_name)
-    else:
-        for item in config.items():
-            table_name = sync_table(item[0], item[1])
-            if table_name:
-                table_names.append(table_name)
+    items = list((namespaces if namespaces else config).items())
+    if not items:
+        return []
+
+    existing_tables = list_existing_tables()
+
+    # Tables are independent so describe/update/create calls are made concurrently (the client is thread-safe).
+    with ThreadPoolExecutor(max_workers = min(SYNC_MAX_WORKERS, len(items))) as executor:
+        futures = [executor.submit(sync_table, path, ns_config, existing_tables) for path, ns_config in items]
+
+    table_names = []
+    pending = []
+    for future in futures:
+        try:
+            table_name = future.result()
+        except ResourcePending as e:
+            # Keep checking the remaining tables so one retry of the state machine step re-checks them all at once.
+            pending.append(str(e))
+            continue
+
+        if table_name:
+            table_names.append(table_name)
+
+    if pending:
+        raise ResourcePending('; '.join(pending))
 
     return table_names
 
 @tracer.capture_method
-def sync_table(path: str, ns_config: Dict) -> str:
+def list_existing_tables() -> Set[str]:
+    """ Returns the names of the existing item metadata tables (tables with the configured name prefix) """
+    existing_tables = set()
+    for page in dynamodb.meta.client.get_paginator('list_tables').paginate():
+        existing_tables.update(table_name for table_name in page['TableNames'] if table_name.startswith(table_name_prefix))
+    return existing_tables
+
+@tracer.capture_method
+def sync_table(path: str, ns_config: Dict, existing_tables: Set[str] = None) -> str:
     if not isinstance(ns_config, dict):
         return ''
 
@@ -63,78 +88,61 @@ def sync_table(path: str, ns_config: Dict) -> str:
     if billing_mode == 'PROVISIONED' and not provisioned_throughput:
         raise Exception(f'"inferenceItemMetadata.provisionedThroughput" is required for billingMode PROVISIONED but is not specfied for namespace ("{path}") in application configuration')
 
-    try:
-        response = dynamodb.meta.client.describe_table(TableName = table_name)
-
-        table_status = response['Table']['TableStatus']
-
-        if response['Table']['BillingModeSummary']['BillingMode'] != billing_mode:
-            logger.info('Updating BillingMode for table %s from %s to %s', table_name, response['Table']['BillingModeSummary']['BillingMode'], billing_mode)
-            if billing_mode == 'PAY_PER_REQUEST':
-                dynamodb.meta.client.update_table(
-                    TableName = table_name,
-                    BillingMode = billing_mode
-                )
-            else:
+    if existing_tables is not None and table_name not in existing_tables:
+        # Known not to exist from the table listing so skip the describe round-trip.
+        logger.info('Table %s does not exist; creating table', table_name)
+        try:
+            table_status = create_table(table_name, billing_mode, provisioned_throughput)
+        except dynamodb.meta.client.exceptions.ResourceInUseException:
+            # Created since the tables were listed; check it again on the next sync.
+            raise ResourcePending(f'Table {table_name} is in-use and cannot be created')
+    else:
+        try:
+            response = dynamodb.meta.client.describe_table(TableName = table_name)
+
+            table_status = response['Table']['TableStatus']
+
+            if table_status in [ 'CREATING', 'UPDATING' ]:
+                # An update would be rejected with ResourceInUseException, so don't spend update_table quota on it.
+                logger.info('Table %s is being created/updated', table_name)
+                raise ResourcePending(f'Table {table_name} is still being created/updated; status is {table_status}')
+
+            if response['Table']['BillingModeSummary']['BillingMode'] != billing_mode:
+                logger.info('Updating BillingMode for table %s from %s to %s', table_name, response['Table']['BillingModeSummary']['BillingMode'], billing_mode)
+                if billing_mode == 'PAY_PER_REQUEST':
+                    dynamodb.meta.client.update_table(
+                        TableName = table_name,
+                        BillingMode = billing_mode
+                    )
+                else:
+                    dynamodb.meta.client.update_table(
+                        TableName = table_name,
+                        BillingMode = billing_mode,
+                        ProvisionedThroughput = {
+                            'ReadCapacityUnits': provisioned_throughput['readCapacityUnits'],
+                            'WriteCapacityUnits': provisioned_throughput['writeCapacityUnits']
+                        }
+                    )
+            elif (billing_mode == 'PROVISIONED' and
+                    (response['Table']['ProvisionedThroughput']['ReadCapacityUnits'] != provisioned_throughput['readCapacityUnits'] or
+                    response['Table']['ProvisionedThroughput']['WriteCapacityUnits'] != provisioned_throughput['writeCapacityUnits'])):
+                logger.info('Provisioned read and/or write capacity units to not match configuration for table %s; updating table', table_name)
                 dynamodb.meta.client.update_table(
                     TableName = table_name,
-                    BillingMode = billing_mode,
                     ProvisionedThroughput = {
                         'ReadCapacityUnits': provisioned_throughput['readCapacityUnits'],
                         'WriteCapacityUnits': provisioned_throughput['writeCapacityUnits']
                     }
                 )
-        elif (billing_mode == 'PROVISIONED' and
-                (response['Table']['ProvisionedThroughput']['ReadCapacityUnits'] != provisioned_throughput['readCapacityUnits'] or
-                response['Table']['ProvisionedThroughput']['WriteCapacityUnits'] != provisioned_throughput['writeCapacityUnits'])):
-            logger.info('Provisioned read and/or write capacity units to not match configuration for table %s; updating table', table_name)
-            dynamodb.meta.client.update_table(
-                TableName = table_name,
-                ProvisionedThroughput = {
-                    'ReadCapacityUnits': provisioned_throughput['readCapacityUnits'],
-                    'WriteCapacityUnits': provisioned_throughput['writeCapacityUnits']
-                }
-            )
-        else:
-            logger.info('Table %s already exists and billing mode (%s) and capacity units match configuration', table_name, billing_mode)
-
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        raise ResourcePending(f'Table {table_name} is in-use and cannot be updated; status is {table_status}')
-
-    except dynamodb.meta.client.exceptions.ResourceNotFoundException:
-        logger.info('Table %s does not exist; creating table', table_name)
-
-        create_params = {
-            'TableName': table_name,
-            'AttributeDefinitions': [
-                {
-                    'AttributeName': primary_key_name,
-                    'AttributeType': 'S',
-                }
-            ],
-            'KeySchema': [
-                {
-                    'AttributeName': primary_key_name,
-                    'KeyType': 'HASH',
-                }
-            ],
-            'BillingMode': billing_mode,
-            'Tags': [{
-                'Key': 'CreatedBy',
-                'Value': 'Personalization-APIs-Solution'
-            }]
-        }
+            else:
+                logger.info('Table %s already exists and billing mode (%s) and capacity units match configuration', table_name, billing_mode)
 
-        logger.debug(create_params)
+        except dynamodb.meta.client.exceptions.ResourceInUseException:
+            raise ResourcePending(f'Table {table_name} is in-use and cannot be updated; status is {table_status}')
 
-        if billing_mode == 'PROVISIONED':
-            create_params['ProvisionedThroughput'] = {
-                'ReadCapacityUnits': provisioned_throughput['readCapacityUnits'],
-                'WriteCapacityUnits': provisioned_throughput['writeCapacityUnits']
-            }
-
-        response = dynamodb.meta.client.create_table(**create_params)
-        table_status = response['TableDescription']['TableStatus']
+        except dynamodb.meta.client.exceptions.ResourceNotFoundException:
+            logger.info('Table %s does not exist; creating table', table_name)
+            table_status = create_table(table_name, billing_mode, provisioned_throughput)
 
     if table_status in [ 'CREATING', 'UPDATING' ]:
         logger.info('Table %s is being created/updated', table_name)
@@ -142,6 +150,41 @@ def sync_table(path: str, ns_config: Dict) -> str:
 
     return table_name
 
+@tracer.capture_method
+def create_table(table_name: str, billing_mode: str, provisioned_throughput: Dict) -> str:
+    """ Creates an item metadata table and returns its status """
+    create_params = {
+        'TableName': table_name,
+        'AttributeDefinitions': [
+            {
+                'AttributeName': primary_key_name,
+                'AttributeType': 'S',
+            }
+        ],
+        'KeySchema': [
+            {
+                'AttributeName': primary_key_name,
+                'KeyType': 'HASH',
+            }
+        ],
+        'BillingMode': billing_mode,
+        'Tags': [{
+            'Key': 'CreatedBy',
+            'Value': 'Personalization-APIs-Solution'
+        }]
+    }
+
+    logger.debug(create_params)
+
+    if billing_mode == 'PROVISIONED':
+        create_params['ProvisionedThroughput'] = {
+            'ReadCapacityUnits': provisioned_throughput['readCapacityUnits'],
+            'WriteCapacityUnits': provisioned_throughput['writeCapacityUnits']
+        }
+
+    response = dynamodb.meta.client.create_table(**create_params)
+    return response['TableDescription']['TableStatus']
+
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
 def lambda_handler(event, _):
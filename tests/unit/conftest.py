@@ -0,0 +1,14 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('StagingBucket', 'staging-bucket')
+os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'true')
+
+# The API function's modules import each other (and the layer) as top-level modules, as they are packaged in Lambda.
+src_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+sys.path[:0] = [os.path.join(src_dir, 'personalization_api_function'), os.path.join(src_dir, 'layer')]
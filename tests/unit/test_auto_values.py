@@ -2,12 +2,12 @@
 # SPDX-License-Identifier: MIT-0
 
 from datetime import datetime
-from pytest import fixture
+from pytest import fixture, mark
 from unittest import mock
 
-from personalization_api_function.auto_values import get_season, resolve_auto_values
+from personalization_api_function.auto_values import compile_auto_context, get_season, resolve_auto_values
 
-@fixture
+@fixture(scope="module")
 def headers_desktop_only():
     return {
         "cloudfront-is-desktop-viewer": "true",
@@ -16,7 +16,7 @@ def headers_desktop_only():
         "cloudfront-is-tablet-viewer": "false",
     }
 
-@fixture
+@fixture(scope="module")
 def headers_mobile_and_tablet():
     return {
         "cloudfront-is-desktop-viewer": "false",
@@ -25,7 +25,7 @@ def headers_mobile_and_tablet():
         "cloudfront-is-tablet-viewer": "true",
     }
 
-@fixture
+@fixture(scope="module")
 def headers_location():
     return {
         "cloudfront-viewer-city": "San Francisco",
@@ -35,7 +35,7 @@ def headers_location():
         "cloudfront-viewer-metro-code": "807"
     }
 
-@fixture
+@fixture(scope="module")
 def auto_context_device_type():
     return {
         "autoContext": {
@@ -93,7 +93,7 @@ def auto_context_device_type():
         }
     }
 
-@fixture
+@fixture(scope="module")
 def auto_context_location():
     return {
         "autoContext": {
@@ -127,7 +127,7 @@ def auto_context_location():
         }
     }
 
-@fixture
+@fixture(scope="module")
 def auto_context_time_of_day():
     return {
         "autoContext": {
@@ -170,7 +170,7 @@ def auto_context_time_of_day():
         }
     }
 
-@fixture
+@fixture(scope="module")
 def auto_context_day_of_week():
     return {
         "autoContext": {
@@ -223,45 +223,55 @@ def auto_context_day_of_week():
         }
     }
 
-def test_season_northern_hemi_spring():
-    dt = datetime(2022, 4, 1)
-    season = get_season(dt, 38.0)
-    assert season == 0
-
-def test_season_northern_hemi_summer():
-    dt = datetime(2022, 7, 1)
-    season = get_season(dt, 38.0)
-    assert season == 1
-
-def test_season_northern_hemi_fall():
-    dt = datetime(2022, 10, 1)
-    season = get_season(dt, 38.0)
-    assert season == 2
-
-def test_season_northern_hemi_winter():
-    dt = datetime(2022, 1, 1)
-    season = get_season(dt, 38.0)
-    assert season == 3
-
-def test_season_southern_hemi_spring():
-    dt = datetime(2022, 4, 1)
-    season = get_season(dt, -38.0)
-    assert season == 2
-
-def test_season_southern_hemi_summer():
-    dt = datetime(2022, 7, 1)
-    season = get_season(dt, -38.0)
-    assert season == 3
-
-def test_season_southern_hemi_fall():
-    dt = datetime(2022, 10, 1)
-    season = get_season(dt, -38.0)
-    assert season == 0
-
-def test_season_southern_hemi_winter():
-    dt = datetime(2022, 1, 1)
-    season = get_season(dt, -38.0)
-    assert season == 1
+@mark.parametrize('dt,latitude,expected', [
+    (datetime(2022, 4, 1), 38.0, 0),
+    (datetime(2022, 7, 1), 38.0, 1),
+    (datetime(2022, 10, 1), 38.0, 2),
+    (datetime(2022, 1, 1), 38.0, 3),
+    (datetime(2022, 4, 1), -38.0, 2),
+    (datetime(2022, 7, 1), -38.0, 3),
+    (datetime(2022, 10, 1), -38.0, 0),
+    (datetime(2022, 1, 1), -38.0, 1)
+])
+def test_season(dt, latitude, expected):
+    assert get_season(dt, latitude) == expected
+
+def test_season_boundaries():
+    assert get_season(datetime(2022, 3, 20), 38.0) == 3
+    assert get_season(datetime(2022, 3, 21), 38.0) == 0
+    assert get_season(datetime(2022, 6, 21), 38.0) == 1
+    assert get_season(datetime(2022, 9, 22), 38.0) == 1
+    assert get_season(datetime(2022, 9, 23), 38.0) == 2
+    assert get_season(datetime(2022, 12, 23), -38.0) == 1
+
+@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
+def test_season_of_year_from_latitude_header(mock_datetime, headers_location):
+    mock_datetime.now.return_value = datetime(2022, 7, 1)
+    auto_context = {
+        "season": {
+            "type": "string",
+            "rules": [
+                {
+                    "type": "season-of-year",
+                    "valueMappings": [
+                        { "operator": "equals", "value": 1, "mapTo": "Summer" },
+                        { "operator": "equals", "value": 3, "mapTo": "Winter" }
+                    ]
+                }
+            ]
+        }
+    }
+
+    assert resolve_auto_values(auto_context, headers_location)['season']['values'] == ['Summer']
+    assert resolve_auto_values(auto_context, { **headers_location, 'cloudfront-viewer-latitude': '-33.86' })['season']['values'] == ['Winter']
+
+def test_compile_auto_context_memoized(auto_context_device_type):
+    auto_context = auto_context_device_type['autoContext']
+    compiled = compile_auto_context(auto_context)
+
+    assert compile_auto_context(auto_context) is compiled
+    assert compile_auto_context({ **auto_context }) is not compiled
+    assert len(compiled[0][4]) == 4
 
 def test_device_type_desktop(headers_desktop_only, auto_context_device_type):
     resolved = resolve_auto_values(auto_context_device_type['autoContext'], headers_desktop_only)
@@ -282,6 +292,38 @@ def test_device_type_phone_and_tablet(headers_mobile_and_tablet, auto_context_de
     assert 'Phone' in resolved['deviceType']['values']
     assert 'Tablet' in resolved['deviceType']['values']
 
+def test_device_type_mixed_case_headers(headers_mobile_and_tablet, auto_context_device_type):
+    headers = { key.title(): value for key, value in headers_mobile_and_tablet.items() }
+    resolved = resolve_auto_values(auto_context_device_type['autoContext'], headers)
+
+    assert sorted(resolved['deviceType']['values']) == ['Phone', 'Tablet']
+
+def test_device_type_flag_table(headers_mobile_and_tablet, auto_context_device_type):
+    compiled = compile_auto_context(auto_context_device_type['autoContext'])
+    flag_headers, table = compiled[0][5]
+
+    assert len(flag_headers) == 4
+    assert len(table) == 16
+    assert table[0] == ('Desktop',)
+    assert table[0b1010] == ('Phone', 'Tablet')
+
+    first_match = { 'deviceType': { **auto_context_device_type['autoContext']['deviceType'], 'evaluateAll': False } }
+    resolved = resolve_auto_values(first_match, headers_mobile_and_tablet)
+    assert resolved['deviceType']['values'] == [ 'Phone' ]
+
+@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
+def test_current_time_determined_once(mock_datetime, auto_context_device_type, auto_context_time_of_day, auto_context_day_of_week, headers_location):
+    mock_datetime.now.return_value = datetime(2022, 2, 21, 8)
+
+    resolve_auto_values(auto_context_device_type['autoContext'], headers_location)
+    assert mock_datetime.now.call_count == 0
+
+    auto_context = { **auto_context_device_type['autoContext'], **auto_context_time_of_day['autoContext'], **auto_context_day_of_week['autoContext'] }
+    resolved = resolve_auto_values(auto_context, headers_location)
+    assert mock_datetime.now.call_count == 1
+    assert resolved['timeOfDay']['values'] == [ 'Morning' ]
+    assert resolved['dayOfWeek']['values'] == [ 'Monday' ]
+
 def test_location(headers_location, auto_context_location):
     resolved = resolve_auto_values(auto_context_location['autoContext'], headers_location)
 
@@ -303,123 +345,32 @@ def test_location(headers_location, auto_context_location):
     assert len(resolved['metroCode']['values']) == 1
     assert '807' in resolved['metroCode']['values']
 
+@mark.parametrize('now,expected', [
+    (datetime(2022, 2, 19, 8), 'Morning'),
+    (datetime(2022, 2, 19, 12), 'Afternoon'),
+    (datetime(2022, 2, 19, 19), 'Evening')
+])
 @mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_time_of_day_morning(mock_datetime, auto_context_time_of_day, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 19, 8)
+def test_time_of_day(mock_datetime, now, expected, auto_context_time_of_day, headers_location):
+    mock_datetime.now.return_value = now
     resolved = resolve_auto_values(auto_context_time_of_day['autoContext'], headers_location)
 
-    assert resolved.get('timeOfDay')
-    assert type(resolved['timeOfDay']) is dict
-    assert resolved['timeOfDay'].get('values')
-    assert len(resolved['timeOfDay']['values']) == 1
-    assert 'Morning' in resolved['timeOfDay']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_time_of_day_afternoon(mock_datetime, auto_context_time_of_day, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 19, 12)
-    resolved = resolve_auto_values(auto_context_time_of_day['autoContext'], headers_location)
-
-    assert resolved.get('timeOfDay')
-    assert type(resolved['timeOfDay']) is dict
-    assert resolved['timeOfDay'].get('values')
-    assert len(resolved['timeOfDay']['values']) == 1
-    assert 'Afternoon' in resolved['timeOfDay']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_time_of_day_evening(mock_datetime, auto_context_time_of_day, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 19, 19)
-    resolved = resolve_auto_values(auto_context_time_of_day['autoContext'], headers_location)
-
-    assert resolved.get('timeOfDay')
-    assert type(resolved['timeOfDay']) is dict
-    assert resolved['timeOfDay'].get('values')
-    assert len(resolved['timeOfDay']['values']) == 1
-    assert 'Evening' in resolved['timeOfDay']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_monday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 21)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Monday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_monday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 21)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Monday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_tuesday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 22)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Tuesday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_wednesday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 23)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Wednesday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_thursday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 24)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Thursday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_friday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 25)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Friday' in resolved['dayOfWeek']['values']
-
-@mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_saturday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 26)
-    resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
-
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Saturday' in resolved['dayOfWeek']['values']
-
+    assert type(resolved.get('timeOfDay')) is dict
+    assert resolved['timeOfDay']['values'] == [ expected ]
+
+@mark.parametrize('now,expected', [
+    (datetime(2022, 2, 21), 'Monday'),
+    (datetime(2022, 2, 22), 'Tuesday'),
+    (datetime(2022, 2, 23), 'Wednesday'),
+    (datetime(2022, 2, 24), 'Thursday'),
+    (datetime(2022, 2, 25), 'Friday'),
+    (datetime(2022, 2, 26), 'Saturday'),
+    (datetime(2022, 2, 27), 'Sunday')
+])
 @mock.patch('personalization_api_function.auto_values.datetime', wraps=datetime)
-def test_day_of_week_sunday(mock_datetime, auto_context_day_of_week, headers_location):
-    mock_datetime.now.return_value = datetime(2022, 2, 27)
+def test_day_of_week(mock_datetime, now, expected, auto_context_day_of_week, headers_location):
+    mock_datetime.now.return_value = now
     resolved = resolve_auto_values(auto_context_day_of_week['autoContext'], headers_location)
 
-    assert resolved.get('dayOfWeek')
-    assert type(resolved['dayOfWeek']) is dict
-    assert resolved['dayOfWeek'].get('values')
-    assert len(resolved['dayOfWeek']['values']) == 1
-    assert 'Sunday' in resolved['dayOfWeek']['values']
+    assert type(resolved.get('dayOfWeek')) is dict
+    assert resolved['dayOfWeek']['values'] == [ expected ]
@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import copy
+
 from pytest import fixture
 from unittest.mock import MagicMock
 
@@ -145,4 +147,16 @@ def test_no_recommenders(obj, config_no_recommenders):
     obj.get_config = MagicMock(return_value = config_no_recommenders)
     ns_config = obj.get_namespace_config('ns-1')
     assert not 'recommenders' in ns_config
-    assert len(ns_config['eventTargets']) == 1
\ No newline at end of file
+    assert len(ns_config['eventTargets']) == 1
+
+def test_merged_configs_memoized_per_config(obj, config_cache_inheritance):
+    obj.get_config = MagicMock(return_value = config_cache_inheritance)
+
+    rec_config = obj.get_recommender_config('ns-inherit-1', 'similar', 'related-items')
+    assert obj.get_recommender_config('ns-inherit-1', 'similar', 'related-items') is rec_config
+    assert obj.get_namespace_config('ns-inherit-1') is obj.get_namespace_config('ns-inherit-1')
+
+    refreshed = copy.deepcopy(config_cache_inheritance)
+    refreshed['namespaces']['ns-inherit-1']['recommenders']['related-items']['similar']['cacheControl']['userSpecified']['maxAge'] = 50
+    obj.get_config = MagicMock(return_value = refreshed)
+    assert obj.get_recommender_config('ns-inherit-1', 'similar', 'related-items')['cacheControl']['userSpecified']['maxAge'] == 50
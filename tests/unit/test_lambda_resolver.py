@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import orjson
+
+from pytest import fixture, raises
+from unittest.mock import MagicMock
+
+from lambda_resolver import LambdaResolver
+from personalization_error import LambdaError
+
+@fixture
+def variation_config():
+    return { 'type': 'function', 'arn': 'arn:aws:lambda:us-east-1:123456789012:function:recs' }
+
+def invoke_response(payload: dict, function_error: str = None) -> dict:
+    response = { 'StatusCode': 200, 'Payload': io.BytesIO(orjson.dumps(payload)) }
+    if function_error:
+        response['FunctionError'] = function_error
+    return response
+
+def test_function_error_not_cached(variation_config):
+    lambda_client = MagicMock()
+    lambda_client.invoke.side_effect = [
+        invoke_response({ 'errorMessage': 'boom', 'errorType': 'Exception' }, 'Unhandled'),
+        invoke_response({ 'itemList': [ { 'itemId': '1' } ] })
+    ]
+    resolver = LambdaResolver(lambda_client)
+
+    with raises(LambdaError) as e:
+        resolver.get_recommend_items('rfy', {}, variation_config, 'u1')
+    assert e.value.error_code == 'FunctionError'
+
+    response = resolver.get_recommend_items('rfy', {}, variation_config, 'u1')
+    assert response['itemList'] == [ { 'itemId': '1' } ]
+    assert lambda_client.invoke.call_count == 2
+
+def test_result_cached(variation_config):
+    lambda_client = MagicMock()
+    lambda_client.invoke.side_effect = [ invoke_response({ 'itemList': [ { 'itemId': '1' } ] }) ]
+    resolver = LambdaResolver(lambda_client)
+
+    assert resolver.get_recommend_items('rfy', {}, variation_config, 'u1') == resolver.get_recommend_items('rfy', {}, variation_config, 'u1')
+    assert lambda_client.invoke.call_count == 1
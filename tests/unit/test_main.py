@@ -0,0 +1,129 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import gzip
+import orjson
+
+from pytest import fixture, raises
+from unittest import mock
+
+from personalization_error import HttpError
+
+import main
+
+@fixture
+def config():
+    return {
+        "namespaces": {
+            "ns": {
+                "recommenders": {
+                    "recommend-items": {
+                        "http": {
+                            "variations": {
+                                "v1": {
+                                    "type": "http",
+                                    "url": "https://recs.example.com/recommend"
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+@fixture
+def upstream_items():
+    return { 'itemList': [ { 'itemId': str(i) } for i in range(100) ] }
+
+def rest_event(path: str, headers: dict = None, query_string: dict = None) -> dict:
+    return {
+        'resource': path,
+        'path': path,
+        'httpMethod': 'GET',
+        'headers': headers or {},
+        'multiValueHeaders': {},
+        'queryStringParameters': query_string,
+        'multiValueQueryStringParameters': None,
+        'pathParameters': None,
+        'requestContext': { 'accountId': '123456789012', 'resourcePath': path, 'httpMethod': 'GET', 'requestId': 'request', 'path': path, 'stage': 'prod' },
+        'body': None,
+        'isBase64Encoded': False
+    }
+
+def resolve(config: dict, event: dict, upstream: mock.MagicMock, compress: bool = True) -> dict:
+    with mock.patch.object(main.config, 'get_config', return_value = config), \
+            mock.patch.object(main, 'http_pool') as http_pool, \
+            mock.patch.object(main, 'compress_responses', compress):
+        http_pool.request.return_value = upstream
+        return main.app.resolve(event, None)
+
+def upstream_response(body: bytes, headers: dict = None, status: int = 200) -> mock.MagicMock:
+    return mock.MagicMock(status = status, headers = headers or {}, data = body)
+
+def test_gzip_response(config, upstream_items):
+    upstream = upstream_response(orjson.dumps(upstream_items))
+
+    response = resolve(config, rest_event('/recommend-items/ns/http/u1', { 'Accept-Encoding': 'gzip' }, { 'numResults': '100' }), upstream)
+    assert response['statusCode'] == 200
+    assert response['isBase64Encoded']
+    assert response['multiValueHeaders']['Content-Encoding'] == ['gzip']
+    assert orjson.loads(gzip.decompress(base64.b64decode(response['body']))) == upstream_items
+
+    response = resolve(config, rest_event('/recommend-items/ns/http/u1', query_string = { 'numResults': '100' }), upstream)
+    assert response['statusCode'] == 200
+    assert not response['isBase64Encoded']
+    assert orjson.loads(response['body']) == upstream_items
+
+def test_gzip_upstream_passthrough(config, upstream_items):
+    upstream_body = gzip.compress(orjson.dumps(upstream_items))
+    upstream = upstream_response(upstream_body, { 'Content-Encoding': 'gzip' })
+
+    response = resolve(config, rest_event('/recommend-items/ns/http/u1', { 'Accept-Encoding': 'gzip' }, { 'numResults': '100' }), upstream)
+    assert response['statusCode'] == 200
+    assert response['isBase64Encoded']
+    assert response['multiValueHeaders']['Content-Encoding'] == ['gzip']
+    assert base64.b64decode(response['body']) == upstream_body
+
+    response = resolve(config, rest_event('/recommend-items/ns/http/u1', query_string = { 'numResults': '5' }), upstream)
+    assert response['statusCode'] == 200
+    assert orjson.loads(response['body'])['itemList'] == upstream_items['itemList'][:5]
+
+def test_function_variation_dispatch():
+    assert main.RESOLVER_DISPATCH[('recommend-items', 'function')] == (main.get_lambda_resolver, 'get_recommend_items')
+    assert main.RESOLVER_DISPATCH[('related-items', 'lambda')] == (main.get_lambda_resolver, 'get_related_items')
+
+def test_function_variation(config):
+    config['namespaces']['ns']['recommenders']['recommend-items']['fn'] = {
+        'variations': {
+            'v1': {
+                'type': 'function',
+                'arn': 'arn:aws:lambda:us-east-1:123456789012:function:recs'
+            }
+        }
+    }
+    resolver = mock.MagicMock()
+    resolver.get_recommend_items.return_value = { 'itemList': [ { 'itemId': '1' } ] }
+
+    with mock.patch.dict(main.RESOLVER_DISPATCH, { ('recommend-items', 'function'): (lambda: resolver, 'get_recommend_items') }):
+        response = resolve(config, rest_event('/recommend-items/ns/fn/u1', query_string = { 'decorateItems': '0' }), None)
+
+    assert response['statusCode'] == 200
+    assert orjson.loads(response['body']) == { 'itemList': [ { 'itemId': '1' } ] }
+    assert resolver.get_recommend_items.call_args.kwargs['user_id'] == 'u1'
+
+def test_http_variation_accepts_any_success_status(config, upstream_items):
+    upstream = upstream_response(orjson.dumps(upstream_items), status = 203)
+
+    response = resolve(config, rest_event('/recommend-items/ns/http/u1', query_string = { 'numResults': '5' }), upstream)
+    assert response['statusCode'] == 200
+    assert orjson.loads(response['body'])['itemList'] == upstream_items['itemList'][:5]
+
+    with raises(HttpError):
+        resolve(config, rest_event('/recommend-items/ns/http/u1'), upstream_response(b'', status = 503))
+
+def test_http_pool_follows_redirects_without_retries():
+    retries = main.http_pool.connection_pool_kw['retries']
+    assert retries.redirect > 0
+    assert not retries.connect and not retries.read and not retries.status and not retries.other
@@ -7,7 +7,7 @@ from unittest.mock import MagicMock
 
 from config_validator_function.openapi import OpenApiGenerator
 
-@fixture
+@fixture(scope="session")
 def sample_config():
     with open('samples/config_simple.json') as file:
         return json.loads(file.read())
@@ -35,3 +35,20 @@ def test_simple_apikey(sample_config):
 
     assert len(openapi['servers']) == 2
     assert len(openapi['security']) == 1
+
+def test_template_not_mutated_across_generate(sample_config):
+    generator = OpenApiGenerator()
+    generator._get_openapi_template_filename = MagicMock(return_value = 'src/config_validator_function/openapi_template.json')
+    generator.generate(
+        apis_config = sample_config,
+        apigw_host = 'https://apigw-host.com',
+        cloudfront_host = 'https://cloudfront-host.com',
+        auth_scheme = 'ApiKey')
+    openapi = generator.generate(
+        apis_config = sample_config,
+        apigw_host = 'https://apigw-host.com',
+        cloudfront_host = None,
+        auth_scheme = 'NONE')
+
+    assert len(openapi['servers']) == 1
+    assert not 'security' in openapi
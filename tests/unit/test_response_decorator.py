@@ -0,0 +1,53 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from pytest import fixture
+from unittest import mock
+
+import response_decorator
+from response_decorator import ResponseDecorator
+
+@fixture
+def config():
+    return {
+        'namespaces': {
+            'ns-localdb': {
+                'inferenceItemMetadata': { 'type': 'localdb' }
+            },
+            'ns-dynamodb': {
+                'inferenceItemMetadata': { 'type': 'dynamodb' }
+            }
+        }
+    }
+
+@fixture(autouse=True)
+def reset_decorator_state():
+    with mock.patch.object(ResponseDecorator, '_decorators', {}), \
+            mock.patch.object(ResponseDecorator, '_last_prepare_check', 0), \
+            mock.patch.object(ResponseDecorator, '_last_localdb_download_attempt', {}), \
+            mock.patch.object(ResponseDecorator, '_warmed_namespaces', set()):
+        yield
+
+@mock.patch.object(response_decorator, 'get_dynamodb_client')
+@mock.patch.object(response_decorator, 'get_s3_client')
+def test_prepare_datastores_creates_clients_on_calling_thread(get_s3_client, get_dynamodb_client, config):
+    background = mock.MagicMock()
+    with mock.patch.object(response_decorator.os.path, 'isfile', return_value = True):
+        ResponseDecorator.prepare_datastores(config, background)
+
+    calls = background.submit_detached.call_args_list
+    assert calls[0].kwargs['s3'] is get_s3_client.return_value
+    assert calls[1].args[1] is get_dynamodb_client.return_value
+
+@mock.patch.object(response_decorator, 'get_s3_client')
+def test_prepare_datastores_waits_for_initial_downloads_together(get_s3_client, config):
+    config['namespaces']['ns-localdb-2'] = { 'inferenceItemMetadata': { 'type': 'localdb' } }
+    del config['namespaces']['ns-dynamodb']
+    background = mock.MagicMock()
+    background.submit_detached.side_effect = [ mock.sentinel.download_1, mock.sentinel.download_2 ]
+
+    with mock.patch.object(response_decorator.os.path, 'isfile', return_value = False), \
+            mock.patch.object(response_decorator, 'wait') as wait:
+        ResponseDecorator.prepare_datastores(config, background)
+
+    wait.assert_called_once_with([ mock.sentinel.download_1, mock.sentinel.download_2 ])
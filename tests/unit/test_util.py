@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import orjson
+
+from decimal import Decimal
+from unittest import mock
+
+from personalization_api_function.util import TTLCache, compat_default, config_hash
+
+def test_ttl_cache_hit():
+    cache = TTLCache(maxsize = 10, ttl = 5)
+    cache.put('key', b'value')
+
+    assert cache.get('key') == b'value'
+    assert cache.get('missing') is None
+
+@mock.patch('personalization_api_function.util.time')
+def test_ttl_cache_expired(mock_time):
+    mock_time.monotonic.return_value = 100.0
+    cache = TTLCache(maxsize = 10, ttl = 5)
+    cache.put('key', b'value')
+
+    mock_time.monotonic.return_value = 106.0
+    assert cache.get('key') is None
+
+@mock.patch('personalization_api_function.util.time')
+def test_ttl_cache_purges_expired_on_put(mock_time):
+    mock_time.monotonic.return_value = 100.0
+    cache = TTLCache(maxsize = 10, ttl = 5)
+    cache.put('a', 1)
+    cache.put('b', 2)
+
+    mock_time.monotonic.return_value = 106.0
+    cache.put('c', 3)
+
+    assert list(cache._entries) == ['c']
+
+def test_ttl_cache_evicts_oldest():
+    cache = TTLCache(maxsize = 2, ttl = 5)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.put('c', 3)
+
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.get('c') == 3
+
+def test_config_hash_stable():
+    config = { 'type': 'function', 'arn': 'arn:aws:lambda:us-east-1:123456789012:function:recs' }
+
+    assert config_hash(config) == config_hash(config)
+    assert config_hash(config) == config_hash(dict(reversed(list(config.items()))))
+    assert config_hash(config) != config_hash({ **config, 'noCache': True })
+
+def test_compat_default_decimal():
+    data = { 'score': Decimal('0.25'), 'count': Decimal('3') }
+    assert orjson.loads(orjson.dumps(data, default = compat_default)) == { 'score': 0.25, 'count': 3 }
+
+def test_compat_default_decimal_sign_and_exponent():
+    data = { 'negative': Decimal('-1.5'), 'scaled': Decimal('1E+2'), 'fraction': Decimal('0.5') }
+    assert orjson.loads(orjson.dumps(data, default = compat_default)) == { 'negative': -1.5, 'scaled': 100, 'fraction': 0.5 }
+    assert isinstance(compat_default(Decimal('1E+2')), int)
+
+def test_compat_default_decimal_integral_with_fraction_digits():
+    assert orjson.dumps({ 'rating': Decimal('1.0') }, default = compat_default) == b'{"rating":1}'
+    assert isinstance(compat_default(Decimal('-2.00')), int)